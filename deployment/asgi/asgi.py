@@ -0,0 +1,5 @@
+from wts.api import app, setup_app
+from wts.asgi import ASGIApp
+
+setup_app(app)
+application = ASGIApp(app)
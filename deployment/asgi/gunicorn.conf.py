@@ -0,0 +1,7 @@
+wsgi_app = "deployment.asgi.asgi:application"
+worker_class = "uvicorn_worker.UvicornWorker"
+bind = "0.0.0.0:8000"
+workers = 1
+user = "gen3"
+group = "gen3"
+timeout = 300
@@ -0,0 +1,84 @@
+"""
+Send concurrent requests to a running WTS and report the throughput and
+latencies, to compare deployments. For example, to compare the WSGI and
+ASGI modes:
+
+    gunicorn -c deployment/wsgi/gunicorn.conf.py
+    python deployment/benchmark.py http://localhost:8000/aggregate/authz/mapping
+
+    gunicorn -c deployment/asgi/gunicorn.conf.py
+    python deployment/benchmark.py http://localhost:8000/aggregate/authz/mapping
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def send_requests(url, headers, count, concurrency):
+    """
+    Return:
+        tuple: (latencies(list), errors(int), duration(float))
+    """
+    latencies = []
+    errors = 0
+    remaining = iter(range(count))
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60) as client:
+
+        async def run_client():
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url)
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[run_client() for _ in range(concurrency)])
+        duration = time.perf_counter() - start
+    return latencies, errors, duration
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("url", help="URL to send GET requests to")
+    parser.add_argument("-n", "--requests", type=int, default=500)
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("--token", help="access token to authenticate with")
+    args = parser.parse_args()
+
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    latencies, errors, duration = asyncio.run(
+        send_requests(args.url, headers, args.requests, args.concurrency)
+    )
+    print(f"{args.requests} requests, concurrency {args.concurrency}")
+    print(f"errors: {errors}")
+    print(f"throughput: {args.requests / duration:.1f} requests/s")
+    if latencies:
+        latencies.sort()
+        print(
+            "latency (ms): mean {:.1f}, p50 {:.1f}, p95 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+                statistics.mean(latencies) * 1000,
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000,
+                latencies[-1] * 1000,
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
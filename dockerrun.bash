@@ -1,4 +1,8 @@
 #!/bin/bash
 
 nginx
-poetry run gunicorn -c "/wts/deployment/wsgi/gunicorn.conf.py"
+if [[ "$WTS_ASGI" == "true" ]]; then
+    poetry run gunicorn -c "/wts/deployment/asgi/gunicorn.conf.py"
+else
+    poetry run gunicorn -c "/wts/deployment/wsgi/gunicorn.conf.py"
+fi
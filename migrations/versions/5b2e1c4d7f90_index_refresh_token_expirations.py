@@ -0,0 +1,29 @@
+"""Index refresh token expirations
+
+Revision ID: 5b2e1c4d7f90
+Revises: 3417aec47fe2
+Create Date: 2026-10-18 12:30:12.482915
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b2e1c4d7f90"
+down_revision = "3417aec47fe2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # used to get the most recent expiration of a user's refresh tokens
+    # for each IdP
+    op.create_index(
+        "refresh_token_username_idp_expires_idx",
+        "refresh_token",
+        ["username", "idp", "expires"],
+    )
+
+
+def downgrade():
+    op.drop_index("refresh_token_username_idp_expires_idx", table_name="refresh_token")
@@ -1,8 +1,17 @@
+import asyncio
 import httpx
 import json
+import mock
 import os
+import threading
+import time
 import uuid
 
+from wts.blueprints.aggregate import get_unexpired_refresh_tokens
+from wts.http_client import HostOverloadedError
+from wts.json_stream import parse_json_response
+from wts.response_cache import AggregateResponseCache
+from wts.tokens import async_get_access_token
 from .conftest import (
     assert_authz_mapping_for_test_user_in_default_commons,
     assert_authz_mapping_for_test_user_in_idp_a_commons,
@@ -210,3 +219,572 @@ def test_aggregate_authz_mapping_endpoint_with_connected_commons(
     assert_authz_mapping_for_test_user_in_idp_a_commons(
         res.json[idp_a_commons_hostname]
     )
+
+
+def test_aggregate_reuses_http_clients(app, client, persisted_refresh_tokens):
+    """
+    Test that the requests to each commons are sent by the same long-lived
+    client, in the worker loop, across requests.
+    """
+    used_clients = []
+    get_client = app.async_http_clients.get_client
+
+    def spy_get_client(host):
+        http_client = get_client(host)
+        used_clients.append((host, http_client))
+        return http_client
+
+    with mock.patch.object(app.async_http_clients, "get_client", spy_get_client):
+        for _ in range(2):
+            res = client.get("/aggregate/index/index")
+            assert res.status_code == 200
+
+    commons_hostnames = app.config["COMMONS_HOSTNAMES"]
+    assert len(used_clients) == 2 * len(commons_hostnames)
+    clients_by_host = {}
+    for host, http_client in used_clients:
+        assert clients_by_host.setdefault(host, http_client) is http_client
+        assert not http_client.is_closed
+    assert len(set(map(id, clients_by_host.values()))) == len(commons_hostnames)
+
+
+def test_aggregate_response_cache(
+    app, client, persisted_refresh_tokens, auth_header, respx_mock
+):
+    """
+    Test that when a TTL is configured for the endpoint, the responses of
+    each commons are cached per user, and that the commons whose response is
+    cached are not queried again.
+    """
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    with mock.patch.dict(
+        app.config["AGGREGATE_ENDPOINT_CACHE_TTLS"], {"/user/user": 60}
+    ):
+        res = client.get("/aggregate/user/user?filters=authz", headers=auth_header)
+        assert res.status_code == 200
+        assert (
+            app.aggregate_response_cache.get(
+                "test", default_commons_hostname, "/user/user", {}, ["authz"]
+            )
+            == res.json[default_commons_hostname]
+        )
+        # failures are not cached
+        failed = [c for c, data in res.json.items() if data is None]
+        for commons in failed:
+            assert (
+                app.aggregate_response_cache.get(
+                    "test", commons, "/user/user", {}, ["authz"]
+                )
+                is None
+            )
+        upstream_calls = len(respx_mock.calls)
+
+        # only the commons which failed to respond are queried again
+        res2 = client.get("/aggregate/user/user?filters=authz", headers=auth_header)
+        assert res2.status_code == 200
+        assert res2.json == res.json
+        new_calls = respx_mock.calls[upstream_calls:]
+        assert {call.request.url.host for call in new_calls} <= set(failed)
+        upstream_calls = len(respx_mock.calls)
+
+        # other filters: not cached
+        res = client.get("/aggregate/user/user?filters=role", headers=auth_header)
+        assert res.status_code == 200
+        new_calls = respx_mock.calls[upstream_calls:]
+        assert default_commons_hostname in {c.request.url.host for c in new_calls}
+        upstream_calls = len(respx_mock.calls)
+
+        # the user's responses are evicted when a refresh token is linked
+        app.aggregate_response_cache.invalidate("test")
+        res = client.get("/aggregate/user/user?filters=authz", headers=auth_header)
+        assert res.status_code == 200
+        new_calls = respx_mock.calls[upstream_calls:]
+        assert default_commons_hostname in {c.request.url.host for c in new_calls}
+
+    # no TTL configured for the endpoint: not cached
+    res = client.get("/aggregate/authz/mapping", headers=auth_header)
+    assert res.status_code == 200
+    assert (
+        app.aggregate_response_cache.get(
+            "test", default_commons_hostname, "/authz/mapping", {}, []
+        )
+        is None
+    )
+
+
+def test_aggregate_response_cache_max_bytes():
+    """
+    Test that the cache is bounded by the JSON size of the responses, and
+    that the least recently used responses are evicted first.
+    """
+    cache = AggregateResponseCache(max_size=100, max_bytes=30)
+    response = {"a": "0123456789"}  # 18 bytes as JSON
+    cache.set("user1", "commons", "/user/user", {}, [], response, 60)
+    cache.set("user2", "commons", "/user/user", {}, [], response, 60)
+    assert cache.size_bytes == 18
+    assert cache.get("user1", "commons", "/user/user", {}, []) is None
+    assert cache.get("user2", "commons", "/user/user", {}, []) == response
+
+    # replacing an entry does not count it twice
+    cache.set("user2", "commons", "/user/user", {}, [], {"a": 1}, 60)
+    assert cache.size_bytes == 7
+
+    # responses larger than the cache are not cached
+    cache.set("user3", "commons", "/user/user", {}, [], {"a": "x" * 30}, 60)
+    assert cache.get("user3", "commons", "/user/user", {}, []) is None
+    assert cache.get("user2", "commons", "/user/user", {}, []) == {"a": 1}
+
+    cache.invalidate("user2")
+    assert cache.size_bytes == 0
+
+
+def test_aggregate_anonymous_response_cache(
+    app, client, db_session, auth_header, respx_mock
+):
+    """
+    Test that the responses to unauthenticated requests are cached once for
+    all the anonymous callers, separately from the users' responses.
+    """
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    with mock.patch.dict(
+        app.config["AGGREGATE_ENDPOINT_CACHE_TTLS"], {"/authz/mapping": 60}
+    ):
+        res = client.get("/aggregate/authz/mapping")
+        assert res.status_code == 200
+        assert_authz_mapping_for_user_without_access_token(
+            res.json[default_commons_hostname]
+        )
+        assert (
+            app.aggregate_response_cache.get(
+                None, default_commons_hostname, "/authz/mapping", {}, []
+            )
+            == res.json[default_commons_hostname]
+        )
+        upstream_calls = len(respx_mock.calls)
+
+        res2 = client.get("/aggregate/authz/mapping")
+        assert res2.status_code == 200
+        assert res2.json == res.json
+        new_calls = respx_mock.calls[upstream_calls:]
+        assert default_commons_hostname not in {c.request.url.host for c in new_calls}
+
+        # authenticated users do not get the anonymous responses
+        res = client.get("/aggregate/authz/mapping", headers=auth_header)
+        assert res.status_code == 200
+        assert app.aggregate_response_cache.get(
+            "test", default_commons_hostname, "/authz/mapping", {}, []
+        )
+
+
+def test_aggregate_coalesces_anonymous_requests(app, respx_mock):
+    """
+    Test that concurrent identical unauthenticated requests to a commons
+    share a single upstream request.
+    """
+    url = "https://coalesce.test/authz/mapping"
+
+    def slow_response(request):
+        time.sleep(0.2)
+        return httpx.Response(200, json={"open": "data"})
+
+    route = respx_mock.get(url).mock(side_effect=slow_response)
+    http_clients = app.async_http_clients
+
+    async def send_requests():
+        return await asyncio.gather(
+            *[
+                http_clients.get_shared("coalesce.test", url, params={"a": "1"})
+                for _ in range(3)
+            ],
+            http_clients.get_shared("coalesce.test", url, params={"a": "2"}),
+        )
+
+    responses = asyncio.run(send_requests())
+    assert [r.json() for r in responses] == [{"open": "data"}] * 4
+    # one request per distinct set of parameters
+    assert route.call_count == 2
+    assert not http_clients._in_flight
+
+    # later requests are not coalesced with completed ones
+    asyncio.run(send_requests())
+    assert route.call_count == 4
+
+    # requests whose responses are processed differently are not coalesced
+    async def read_json(response):
+        await response.aread()
+        return response.json()
+
+    async def send_processed_requests():
+        return await asyncio.gather(
+            *[
+                http_clients.get_shared(
+                    "coalesce.test", url, handler=read_json, handler_key=key
+                )
+                for key in ["a", "a", "b"]
+            ]
+        )
+
+    assert asyncio.run(send_processed_requests()) == [{"open": "data"}] * 3
+    assert route.call_count == 6
+
+
+def test_aggregate_timeout(app, client, respx_mock):
+    """
+    Test that when the configured timeout expires, the commons which did not
+    respond are returned as `null`, listed in the `X-Aggregate-Timed-Out`
+    header, and that their requests are cancelled.
+    """
+    slow_commons = app.config["OIDC"]["default"]["commons_hostname"]
+    get_shared = app.async_http_clients.get_shared
+    cancelled = []
+
+    async def slow_get_shared(host, url, **kwargs):
+        if host != slow_commons:
+            return await get_shared(host, url, **kwargs)
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(host)
+            raise
+
+    with mock.patch.object(
+        app.async_http_clients, "get_shared", slow_get_shared
+    ), mock.patch.dict(
+        app.config["AGGREGATE_ENDPOINT_TIMEOUTS"], {"/authz/mapping": 0.5}
+    ):
+        start = time.time()
+        res = client.get("/aggregate/authz/mapping")
+        assert time.time() - start < 5
+
+    assert res.status_code == 200
+    assert res.json[slow_commons] is None
+    assert res.headers["X-Aggregate-Timed-Out"] == slow_commons
+    assert cancelled == [slow_commons]
+    other_commons = app.config["OIDC"]["idp_a"]["commons_hostname"]
+    assert_authz_mapping_for_user_without_access_token(res.json[other_commons])
+
+    # no timeout configured
+    res = client.get("/aggregate/authz/mapping")
+    assert res.status_code == 200
+    assert "X-Aggregate-Timed-Out" not in res.headers
+    assert res.json[slow_commons] is not None
+
+
+def test_shared_request_cancelled_with_last_caller(app, respx_mock):
+    """
+    Test that a shared request is only cancelled when all its callers are.
+    """
+    url = "https://coalesce.test/slow"
+
+    def slow_response(request):
+        time.sleep(0.2)
+        return httpx.Response(200, json={})
+
+    respx_mock.get(url).mock(side_effect=slow_response)
+    http_clients = app.async_http_clients
+    submitted = []
+    submit = http_clients.worker_loop.submit
+
+    def spy_submit(coroutine):
+        future = submit(coroutine)
+        submitted.append(future)
+        return future
+
+    async def cancel_callers(cancel_all):
+        callers = [
+            asyncio.ensure_future(http_clients.get_shared("coalesce.test", url))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        callers[0].cancel()
+        if cancel_all:
+            callers[1].cancel()
+        return await asyncio.gather(*callers, return_exceptions=True)
+
+    with mock.patch.object(http_clients.worker_loop, "submit", spy_submit):
+        results = asyncio.run(cancel_callers(cancel_all=False))
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1].status_code == 200
+        assert not submitted[0].cancelled()
+
+        asyncio.run(cancel_callers(cancel_all=True))
+        assert submitted[1].cancelled()
+    assert not http_clients._in_flight
+
+
+def test_aggregate_ndjson_stream(
+    app, client, persisted_refresh_tokens, auth_header, respx_mock
+):
+    """
+    Test that with `format=ndjson` or an `application/x-ndjson` Accept
+    header, one record per commons is streamed as each commons responds.
+    """
+    commons_hostnames = app.config["COMMONS_HOSTNAMES"]
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    for res in [
+        client.get("/aggregate/authz/mapping?format=ndjson"),
+        client.get(
+            "/aggregate/authz/mapping", headers={"Accept": "application/x-ndjson"}
+        ),
+    ]:
+        assert res.status_code == 200
+        assert res.mimetype == "application/x-ndjson"
+        records = [json.loads(line) for line in res.data.decode().splitlines()]
+        assert len(records) == len(commons_hostnames)
+        assert all(len(record) == 1 for record in records)
+        responses = {k: v for record in records for k, v in record.items()}
+        assert set(responses) == set(commons_hostnames)
+        assert_authz_mapping_for_user_without_access_token(
+            responses[default_commons_hostname]
+        )
+
+    res = client.get("/aggregate/authz/mapping?format=ndjson", headers=auth_header)
+    assert res.status_code == 200
+    responses = {}
+    for line in res.data.decode().splitlines():
+        responses.update(json.loads(line))
+    assert_authz_mapping_for_test_user_in_default_commons(
+        responses[default_commons_hostname]
+    )
+
+    # the `format` parameter is not sent to the commons
+    assert all("format" not in call.request.url.params for call in respx_mock.calls)
+
+    # other `format` values are meant for the commons
+    respx_mock.reset()
+    res = client.get("/aggregate/authz/mapping?format=json")
+    assert res.status_code == 200
+    assert res.mimetype == "application/json"
+    assert respx_mock.calls
+    assert all(call.request.url.params["format"] == "json" for call in respx_mock.calls)
+
+
+def test_aggregate_ndjson_stream_timeout(app, client):
+    """
+    Test that the commons which respond first are streamed first, and that
+    the commons which did not respond in time are streamed as timed out.
+    """
+    slow_commons = app.config["OIDC"]["default"]["commons_hostname"]
+    get_shared = app.async_http_clients.get_shared
+
+    async def slow_get_shared(host, url, **kwargs):
+        if host == slow_commons:
+            await asyncio.sleep(5)
+        return await get_shared(host, url, **kwargs)
+
+    with mock.patch.object(
+        app.async_http_clients, "get_shared", slow_get_shared
+    ), mock.patch.dict(
+        app.config["AGGREGATE_ENDPOINT_TIMEOUTS"], {"/authz/mapping": 0.5}
+    ):
+        res = client.get("/aggregate/authz/mapping?format=ndjson")
+        records = [json.loads(line) for line in res.data.decode().splitlines()]
+
+    assert len(records) == len(app.config["COMMONS_HOSTNAMES"])
+    assert records[-1] == {slow_commons: None, "timed_out": True}
+    assert all(slow_commons not in record for record in records[:-1])
+
+
+def test_aggregate_nested_filters(app, client, persisted_refresh_tokens, auth_header):
+    """
+    Test that nested and wildcard filters select parts of each response.
+    """
+    res = client.get(
+        "/aggregate/user/user?filters=authz.*.*.method&filters=role",
+        headers=auth_header,
+    )
+    assert res.status_code == 200
+
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    data = res.json[default_commons_hostname]
+    assert set(data) == {"authz", "role"}
+    assert_authz_mapping_for_test_user_in_default_commons(data["authz"])
+    for permissions in data["authz"].values():
+        assert permissions == [{"method": "read"}]
+
+    res = client.get("/aggregate/user/user?filters=authz..method", headers=auth_header)
+    assert res.status_code == 400
+
+
+def test_aggregate_max_response_size(
+    app, client, persisted_refresh_tokens, auth_header
+):
+    """
+    Test that the commons whose response is larger than the configured max
+    size are returned as `null`.
+    """
+    for headers in [auth_header, {}]:
+        with mock.patch.dict(app.config, {"AGGREGATE_MAX_RESPONSE_SIZE": 10}):
+            res = client.get("/aggregate/authz/mapping", headers=headers)
+        assert res.status_code == 200
+        assert all(data is None for data in res.json.values())
+
+    with mock.patch.dict(app.config, {"AGGREGATE_MAX_RESPONSE_SIZE": 100000}):
+        res = client.get("/aggregate/authz/mapping", headers=auth_header)
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    assert_authz_mapping_for_test_user_in_default_commons(
+        res.json[default_commons_hostname]
+    )
+
+
+def test_aggregate_anonymous_responses_parsed_with_filters(app, client):
+    """
+    Test that the shared responses to unauthenticated requests are parsed
+    with the request's filters and size limit.
+    """
+    with mock.patch(
+        "wts.blueprints.aggregate.parse_json_response", wraps=parse_json_response
+    ) as spy_parse_json_response:
+        res = client.get("/aggregate/authz/mapping?filters=/open")
+    assert res.status_code == 200
+    assert spy_parse_json_response.call_count == len(app.config["COMMONS_HOSTNAMES"])
+    for call in spy_parse_json_response.call_args_list:
+        assert call.args[1].paths == ("/open",)
+
+
+def test_aggregate_queries_db_outside_event_loop(
+    app, client, persisted_refresh_tokens, auth_header
+):
+    """
+    Test that the refresh tokens are queried in the database executor, not
+    in the thread running the event loop.
+    """
+    query_threads = []
+
+    def spy_get_unexpired_refresh_tokens(username):
+        query_threads.append(threading.current_thread().name)
+        return get_unexpired_refresh_tokens(username)
+
+    with mock.patch(
+        "wts.blueprints.aggregate.get_unexpired_refresh_tokens",
+        spy_get_unexpired_refresh_tokens,
+    ):
+        res = client.get("/aggregate/authz/mapping", headers=auth_header)
+    assert res.status_code == 200
+    assert len(query_threads) == 1
+    assert query_threads[0].startswith("wts-db")
+
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    assert_authz_mapping_for_test_user_in_default_commons(
+        res.json[default_commons_hostname]
+    )
+
+
+def test_aggregate_bulkhead(app, respx_mock):
+    """
+    Test that past the max number of concurrent and queued requests to a
+    host, requests fail right away.
+    """
+    url = "https://bulkhead.test/slow"
+
+    async def slow_response(request):
+        await asyncio.sleep(0.2)
+        return httpx.Response(200, json={})
+
+    route = respx_mock.get(url).mock(side_effect=slow_response)
+    http_clients = app.async_http_clients
+
+    async def send_requests():
+        return await asyncio.gather(
+            *[http_clients.get("bulkhead.test", url) for _ in range(3)],
+            return_exceptions=True,
+        )
+
+    with mock.patch.object(http_clients, "max_concurrency", 1), mock.patch.object(
+        http_clients, "max_queue", 1
+    ), mock.patch.dict(http_clients._bulkheads, clear=True):
+        results = asyncio.run(send_requests())
+        bulkhead = http_clients.get_bulkhead("bulkhead.test")
+        assert bulkhead.waiting == 0
+        assert not bulkhead._semaphore.locked()
+
+    # 1 request running, 1 waiting for it to finish, 1 failing
+    assert [r.status_code for r in results[:2]] == [200, 200]
+    assert isinstance(results[2], HostOverloadedError)
+    assert route.call_count == 2
+
+
+def test_aggregate_overloaded_commons(app, client):
+    """
+    Test that the overloaded commons are returned as `null`.
+    """
+    overloaded = mock.MagicMock()
+    overloaded.__aenter__.side_effect = HostOverloadedError("too many requests")
+    with mock.patch.object(
+        app.async_http_clients, "get_bulkhead", return_value=overloaded
+    ):
+        res = client.get("/aggregate/authz/mapping")
+    assert res.status_code == 200
+    assert all(data is None for data in res.json.values())
+
+
+def test_aggregate_batch(app, client, persisted_refresh_tokens, auth_header):
+    """
+    Test that a batch request returns the responses of all the endpoints,
+    querying the refresh tokens once and getting a single access token per
+    commons.
+    """
+    token_requests = []
+
+    async def spy_async_get_access_token(refresh_token, commons_hostname):
+        token_requests.append(commons_hostname)
+        return await async_get_access_token(refresh_token, commons_hostname)
+
+    with mock.patch(
+        "wts.blueprints.aggregate.get_unexpired_refresh_tokens",
+        wraps=get_unexpired_refresh_tokens,
+    ) as spy_get_unexpired_refresh_tokens, mock.patch(
+        "wts.blueprints.aggregate.async_get_access_token",
+        spy_async_get_access_token,
+    ):
+        res = client.post(
+            "/aggregate",
+            json=[
+                {"endpoint": "/user/user", "filters": ["authz"]},
+                {"endpoint": "/authz/mapping"},
+            ],
+            headers=auth_header,
+        )
+    assert res.status_code == 200
+    assert set(res.json) == {"/user/user", "/authz/mapping"}
+    assert spy_get_unexpired_refresh_tokens.call_count == 1
+    assert sorted(token_requests) == sorted(app.config["COMMONS_HOSTNAMES"])
+
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    assert list(res.json["/user/user"][default_commons_hostname]) == ["authz"]
+    assert_authz_mapping_for_test_user_in_default_commons(
+        res.json["/user/user"][default_commons_hostname]["authz"]
+    )
+    assert_authz_mapping_for_test_user_in_default_commons(
+        res.json["/authz/mapping"][default_commons_hostname]
+    )
+    idp_a_commons_hostname = app.config["OIDC"]["idp_a"]["commons_hostname"]
+    assert_authz_mapping_for_test_user_in_idp_a_commons(
+        res.json["/authz/mapping"][idp_a_commons_hostname]
+    )
+
+
+def test_aggregate_batch_invalid_requests(client, auth_header):
+    """
+    Test that a batch request is rejected if its body is invalid or if one of
+    its endpoints is not in the allowlist.
+    """
+    for body in [
+        None,
+        [],
+        {"endpoint": "/user/user"},
+        [{"filters": ["authz"]}],
+        [{"endpoint": "/user/user", "parameters": {"a": 1}}],
+        [{"endpoint": "/user/user", "filters": "authz"}],
+        [{"endpoint": "/user/user", "filters": ["authz..method"]}],
+        [{"endpoint": "/user/user"}, {"endpoint": "/user/user/"}],
+    ]:
+        res = client.post("/aggregate", json=body, headers=auth_header)
+        assert res.status_code == 400, body
+
+    res = client.post(
+        "/aggregate",
+        json=[{"endpoint": "/user/user"}, {"endpoint": "/user/credentials/api"}],
+        headers=auth_header,
+    )
+    assert res.status_code == 404
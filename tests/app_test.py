@@ -1,6 +1,8 @@
 from urllib.parse import urljoin
 import flask
+import httpx
 import json
+import jwt
 import mock
 import os
 import time
@@ -10,6 +12,11 @@ import urllib
 from authlib.oauth2.client import OAuth2Client
 from authlib.integrations.requests_client import OAuth2Session
 
+import wts.token_validation
+from wts.blueprints.external_oidc import (
+    get_refresh_token_expiration_timestamps,
+    ProviderSnapshot,
+)
 from wts.models import RefreshToken
 from wts.resources.oauth2 import find_valid_refresh_token
 
@@ -49,6 +56,44 @@ def test_connected_endpoint_with_persisted_refresh_tokens(
     assert res.status_code == 200
 
 
+def test_validated_token_claims_are_cached(
+    app, client, auth_header, persisted_refresh_tokens
+):
+    with mock.patch(
+        "wts.token_validation.validate_jwt", wraps=wts.token_validation.validate_jwt
+    ) as validate_jwt:
+        res = client.get("/oauth2/connected", headers=auth_header)
+        assert res.status_code == 200
+        res = client.get("/token/?idp=idp_a", headers=auth_header)
+        assert res.status_code == 200
+        res = client.get("/external_oidc/", headers=auth_header)
+        assert res.status_code == 200
+        assert validate_jwt.call_count == 1
+
+        # an invalid token is rejected every time
+        for _ in range(2):
+            res = client.get(
+                "/oauth2/connected", headers={"Authorization": "Bearer invalid"}
+            )
+            assert res.status_code == 401
+        assert validate_jwt.call_count == 1
+
+
+def test_token_validation_does_not_change_config(
+    app, client, auth_header, persisted_refresh_tokens
+):
+    user_api = app.config["USER_API"]
+
+    # the token is issued by the default IdP, not by "idp_a"
+    res = client.get("/oauth2/connected?idp=idp_a", headers=auth_header)
+    assert res.status_code == 401
+    res = client.get("/oauth2/connected?idp=default", headers=auth_header)
+    assert res.status_code == 200
+
+    assert app.config["USER_API"] == user_api
+    assert "OIDC_ISSUER" not in app.config
+
+
 def test_token_endpoint_with_default_idp(client, persisted_refresh_tokens, auth_header):
     res = client.get("/token/?idp=default", headers=auth_header)
     assert res.status_code == 403
@@ -64,6 +109,38 @@ def test_token_endpoint_with_idp_a(client, persisted_refresh_tokens, auth_header
     assert res.json["token"] == f"access_token_for_{original_refresh_token}"
 
 
+def test_token_endpoint_caches_access_token(
+    app, client, persisted_refresh_tokens, auth_header, respx_mock
+):
+    # the access tokens minted by this mocked IdP are valid for 10 minutes
+    def post_token_side_effect(request):
+        claims = {"exp": int(time.time()) + 600, "jti": str(uuid.uuid4())}
+        access_token = jwt.encode(claims, key="secret", algorithm="HS256")
+        return httpx.Response(200, json={"access_token": access_token})
+
+    idp_a_fence_url = app.config["OIDC"]["idp_a"]["api_base_url"].rstrip("/")
+    token_route = respx_mock.post(f"{idp_a_fence_url}/oauth2/token").mock(
+        side_effect=post_token_side_effect
+    )
+
+    res = client.get("/token/?idp=idp_a", headers=auth_header)
+    assert res.status_code == 200
+    first_token = res.json["token"]
+    assert token_route.call_count == 1
+
+    # the cached token is returned
+    res = client.get("/token/?idp=idp_a&expires=300", headers=auth_header)
+    assert res.status_code == 200
+    assert res.json["token"] == first_token
+    assert token_route.call_count == 1
+
+    # the cached token does not cover the requested lifetime: get a new one
+    res = client.get("/token/?idp=idp_a&expires=3600", headers=auth_header)
+    assert res.status_code == 200
+    assert res.json["token"] != first_token
+    assert token_route.call_count == 2
+
+
 def test_token_endpoint_without_specifying_idp(
     client, persisted_refresh_tokens, auth_header
 ):
@@ -159,6 +236,9 @@ def test_authorize_endpoint(client, test_user, db_session, auth_header):
         else:
             assert original_refresh_token == fake_tokens["idp_a"]
 
+    patched_fetch_access_token.stop()
+    patched_jwt_decode.stop()
+
 
 def test_fetch_token_header(client, test_user, db_session, auth_header, app):
     fake_tokens = {"default": "eyJhbGciOiJvvvv", "idp_a": "eyJhbGciOiJwwww"}
@@ -233,6 +313,7 @@ def test_fetch_token_header(client, test_user, db_session, auth_header, app):
             state=fake_state,
         )
         assert res.status_code == 200
+        patched_jwt_decode.stop()
 
 
 def test_authorization_url_endpoint(client):
@@ -286,6 +367,154 @@ def test_external_oidc_endpoint_with_persisted_refresh_tokens(
             assert provider["refresh_token_expiration"] == None
 
 
+def test_external_oidc_endpoint_conditional_get(
+    app, client, db_session, persisted_refresh_tokens, auth_header
+):
+    res = client.get("/external_oidc/", headers=auth_header)
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+
+    # the response did not change
+    headers = auth_header + [("If-None-Match", etag)]
+    with mock.patch("wts.blueprints.external_oidc.db.session.query") as query:
+        res = client.get("/external_oidc/", headers=headers)
+        # the user's expirations are cached
+        query.assert_not_called()
+    assert res.status_code == 304
+    assert res.data == b""
+    assert res.headers["ETag"] == etag
+
+    # the response is different when only unexpired IdPs are requested
+    res = client.get("/external_oidc/?unexpired=true", headers=headers)
+    assert res.status_code == 200
+    assert [p["idp"] for p in res.json["providers"]] == ["idp_a"]
+
+    # the user's refresh token is deleted; linking a refresh token
+    # invalidates the cached expirations
+    db_session.query(RefreshToken).filter_by(idp="idp_a").delete()
+    db_session.commit()
+    app.refresh_token_expiration_cache.invalidate("test")
+    res = client.get("/external_oidc/", headers=headers)
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+    assert all(p["refresh_token_expiration"] is None for p in res.json["providers"])
+
+
+def read_event(chunks):
+    """
+    Return the next server-sent event, skipping comments and "retry" lines
+    """
+    for chunk in chunks:
+        chunk = chunk.decode("utf-8") if isinstance(chunk, bytes) else chunk
+        fields = dict(
+            line.split(": ", 1)
+            for line in chunk.strip().split("\n")
+            if line and not line.startswith(":")
+        )
+        if "event" in fields:
+            return fields
+    return None
+
+
+def test_external_oidc_stream(
+    app, client, db_session, persisted_refresh_tokens, auth_header
+):
+    config = {
+        "EXTERNAL_OIDC_STREAM_CHECK_INTERVAL": 1,
+        "EXTERNAL_OIDC_STREAM_MAX_DURATION": 1,
+    }
+    etag = client.get("/external_oidc/", headers=auth_header).headers["ETag"]
+    with mock.patch.dict(app.config, config):
+        res = client.get("/external_oidc/stream", headers=auth_header, buffered=False)
+        assert res.status_code == 200
+        assert res.mimetype == "text/event-stream"
+        chunks = iter(res.response)
+
+        # the current providers are sent when the stream is opened
+        event = read_event(chunks)
+        assert event["event"] == "providers"
+        providers = json.loads(event["data"])["providers"]
+        assert [p["idp"] for p in providers if p["refresh_token_expiration"]] == [
+            "idp_a"
+        ]
+        # the event ID is the response's ETag
+        assert '"{}"'.format(event["id"]) == etag
+
+        # the user's refresh token is replaced by a refresh token that
+        # expired: the change is sent right away
+        db_session.query(RefreshToken).filter_by(idp="idp_a").delete()
+        db_session.commit()
+        app.refresh_token_expiration_cache.invalidate("test")
+        app.refresh_token_events.publish("test")
+        event = read_event(chunks)
+        providers = json.loads(event["data"])["providers"]
+        assert all(p["refresh_token_expiration"] is None for p in providers)
+
+        # no other event until the stream is closed
+        assert read_event(chunks) is None
+        res.close()
+    assert app.refresh_token_events.count() == 0
+
+    # the client reconnects: the response did not change
+    with mock.patch.dict(app.config, {"EXTERNAL_OIDC_STREAM_MAX_DURATION": 0}):
+        res = client.get(
+            "/external_oidc/stream",
+            headers=auth_header + [("Last-Event-ID", event["id"])],
+        )
+        assert read_event([res.data]) is None
+
+
+def test_external_oidc_stream_requires_authentication(client):
+    res = client.get("/external_oidc/stream")
+    assert res.status_code == 401
+
+
+def test_provider_snapshot_to_json():
+    providers = [
+        {"idp": "idp_a", "name": "IDP A", "urls": [{"name": "IDP A", "url": "a"}]},
+        {"idp": "idp_b", "name": "IDP B", "urls": [{"name": "IDP B", "url": "b"}]},
+    ]
+    snapshot = ProviderSnapshot(providers)
+    expirations = {"idp_a": "3 days", "idp_b": None}
+
+    assert json.loads(snapshot.to_json(expirations)) == {
+        "providers": [
+            dict(providers[0], refresh_token_expiration="3 days"),
+            dict(providers[1], refresh_token_expiration=None),
+        ]
+    }
+    assert json.loads(snapshot.to_json(expirations, unexpired_only=True)) == {
+        "providers": [dict(providers[0], refresh_token_expiration="3 days")]
+    }
+    assert json.loads(snapshot.to_json({"idp_a": None, "idp_b": None}, True)) == {
+        "providers": []
+    }
+    # the providers are not modified
+    assert "refresh_token_expiration" not in providers[0]
+
+
+def test_refresh_token_expirations_use_most_recent_token(app, db_session):
+    now = int(time.time())
+    for i, expires in enumerate([now + 100, now + 3 * 86400, now - 10]):
+        db_session.add(
+            RefreshToken(
+                idp="idp_a",
+                token=f"token_{i}",
+                username="test",
+                userid="test",
+                expires=expires,
+                jti=str(uuid.uuid4()),
+            )
+        )
+    db_session.commit()
+
+    with app.app_context():
+        expirations = get_refresh_token_expiration_timestamps(
+            "test", ["idp_a", "idp_b"]
+        )
+    assert expirations == {"idp_a": now + 3 * 86400, "idp_b": None}
+
+
 def test_revoke_token_header(client, auth_header, app):
 
     url = urljoin(app.config.get("USER_API"), "/oauth2/revoke")
@@ -328,3 +557,11 @@ def test_app_config(app):
         == "https://some.data.commons/user/oauth2/authorize?idp=google"
     )
     assert client.metadata["api_base_url"] == "https://some.data.commons/user/"
+
+
+def test_http_clients_config(app):
+    # each IdP has its own connection pool, kept for the lifetime of the app
+    assert set(app.http_clients.keys()) == set(app.config["OIDC"].keys())
+    assert app.http_clients["idp_a"] is not app.http_clients["default"]
+    http_client = app.http_clients["idp_a"]
+    assert http_client.timeout.read == app.config["HTTP_CLIENT_TIMEOUT"]
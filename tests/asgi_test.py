@@ -0,0 +1,234 @@
+import asyncio
+import json
+import mock
+import threading
+
+from wts.asgi import ASGIApp
+from wts.models import RefreshToken
+from wts.worker_loop import worker_loop
+
+from .conftest import assert_authz_mapping_for_user_without_access_token
+
+
+async def start_lifespan(asgi_app):
+    messages = asyncio.Queue()
+    sent = asyncio.Queue()
+    task = asyncio.ensure_future(asgi_app({"type": "lifespan"}, messages.get, sent.put))
+    await messages.put({"type": "lifespan.startup"})
+    assert (await sent.get())["type"] == "lifespan.startup.complete"
+
+    async def shutdown():
+        await messages.put({"type": "lifespan.shutdown"})
+        assert (await sent.get())["type"] == "lifespan.shutdown.complete"
+        await task
+
+    return shutdown
+
+
+def make_scope(path, headers=()):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"localhost")]
+        + [(k.lower().encode(), v.encode()) for k, v in headers],
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 12345),
+    }
+
+
+async def get(asgi_app, path):
+    """
+    Return:
+        tuple: (status code, body) of the response to `GET path`
+    """
+    scope = make_scope(path)
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+    messages = []
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    status = messages[0]["status"]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return status, body
+
+
+def test_asgi_app(app, db_session):
+    """
+    Test that the ASGI app serves the sync and async views, and that the
+    async views and the pooled HTTP clients use the server's event loop.
+    """
+    asgi_app = ASGIApp(app)
+    request_loops = []
+    get_shared = app.async_http_clients.get_shared
+
+    async def spy_get_shared(host, url, **kwargs):
+        request_loops.append(asyncio.get_running_loop())
+        return await get_shared(host, url, **kwargs)
+
+    async def serve():
+        shutdown = await start_lifespan(asgi_app)
+        server_loop = asyncio.get_running_loop()
+        assert worker_loop.loop is server_loop
+
+        status, body = await get(asgi_app, "/_status")
+        assert status == 200
+
+        with mock.patch.object(app.async_http_clients, "get_shared", spy_get_shared):
+            status, body = await get(asgi_app, "/aggregate/authz/mapping")
+        assert status == 200
+        assert request_loops
+        assert all(loop is server_loop for loop in request_loops)
+
+        await shutdown()
+        assert worker_loop.loop is not server_loop
+        return json.loads(body)
+
+    responses = asyncio.run(serve())
+    default_commons_hostname = app.config["OIDC"]["default"]["commons_hostname"]
+    assert_authz_mapping_for_user_without_access_token(
+        responses[default_commons_hostname]
+    )
+
+
+def test_asgi_app_thread_pool(app, db_session):
+    """
+    Test that the Flask views run in the bounded pool of threads shared by
+    all the requests.
+    """
+    with mock.patch.dict(app.config, {"ASGI_EXECUTOR_MAX_WORKERS": 2}):
+        asgi_app = ASGIApp(app)
+    threads = []
+    wsgi_app = app.wsgi_app
+
+    def spy_wsgi_app(environ, start_response):
+        threads.append(threading.current_thread().name)
+        return wsgi_app(environ, start_response)
+
+    async def serve():
+        shutdown = await start_lifespan(asgi_app)
+        responses = await asyncio.gather(*[get(asgi_app, "/_status") for _ in range(6)])
+        await shutdown()
+        return responses
+
+    with mock.patch.object(app, "wsgi_app", spy_wsgi_app):
+        responses = asyncio.run(serve())
+    assert all(status == 200 for status, _ in responses)
+    assert len(threads) == 6
+    assert all(name.startswith("wts-asgi") for name in threads)
+    assert len(set(threads)) <= 2
+
+
+def test_asgi_app_max_queued_requests(app, db_session):
+    """
+    Test that the requests past the threads and the queue are answered with
+    a 503 error right away, and that the other requests are served.
+    """
+    config = {"ASGI_EXECUTOR_MAX_WORKERS": 1, "ASGI_MAX_QUEUED_REQUESTS": 1}
+    with mock.patch.dict(app.config, config):
+        asgi_app = ASGIApp(app)
+    release = threading.Event()
+    wsgi_app = app.wsgi_app
+
+    def blocking_wsgi_app(environ, start_response):
+        release.wait(5)
+        return wsgi_app(environ, start_response)
+
+    async def serve():
+        shutdown = await start_lifespan(asgi_app)
+        requests = [asyncio.ensure_future(get(asgi_app, "/_status")) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        # one request is running and one is waiting for the thread
+        status, body = await asyncio.wait_for(get(asgi_app, "/_status"), 1)
+        assert status == 503
+        assert json.loads(body) == {"message": "Too many requests, try again later"}
+        release.set()
+        responses = await asyncio.gather(*requests)
+        await shutdown()
+        return responses
+
+    with mock.patch.object(app, "wsgi_app", blocking_wsgi_app):
+        responses = asyncio.run(serve())
+    assert [status for status, _ in responses] == [200, 200]
+    assert asgi_app.pending == 0
+
+
+def test_asgi_external_oidc_stream(
+    app, db_session, persisted_refresh_tokens, auth_header
+):
+    """
+    Test that the `/external_oidc/stream` events are sent from the server's
+    event loop, that a change wakes the stream up, and that the stream is
+    closed when the client disconnects.
+    """
+    asgi_app = ASGIApp(app)
+    config = {
+        "EXTERNAL_OIDC_STREAM_CHECK_INTERVAL": 60,
+        "EXTERNAL_OIDC_STREAM_MAX_DURATION": 60,
+    }
+
+    async def read_event(messages):
+        while True:
+            message = await asyncio.wait_for(messages.get(), 5)
+            assert message["more_body"]
+            chunk = message["body"].decode("utf-8")
+            if chunk.startswith("event: providers"):
+                return chunk
+
+    async def serve():
+        shutdown = await start_lifespan(asgi_app)
+        messages = asyncio.Queue()
+        disconnected = asyncio.Event()
+        requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        stream = asyncio.ensure_future(
+            asgi_app(
+                make_scope("/external_oidc/stream", auth_header), receive, messages.put
+            )
+        )
+        start = await asyncio.wait_for(messages.get(), 5)
+        assert start["status"] == 200
+        assert (b"content-type", b"text/event-stream; charset=utf-8") in start[
+            "headers"
+        ]
+        # the current providers are sent when the stream is opened
+        await read_event(messages)
+        assert app.refresh_token_events.count() == 1
+        # the stream waits in the server's event loop, not in a thread
+        (subscription,) = app.refresh_token_events._subscriptions["test"]
+        assert subscription.loop is asyncio.get_running_loop()
+
+        # a change is sent right away, way before the check interval
+        db_session.query(RefreshToken).filter_by(idp="idp_a").delete()
+        db_session.commit()
+        app.refresh_token_expiration_cache.invalidate("test")
+        await asyncio.to_thread(app.refresh_token_events.publish, "test")
+        event = await read_event(messages)
+        assert '"refresh_token_expiration":"' not in event
+
+        disconnected.set()
+        await asyncio.wait_for(stream, 5)
+        assert app.refresh_token_events.count() == 0
+        await shutdown()
+
+    with mock.patch.dict(app.config, config):
+        asyncio.run(serve())
@@ -358,3 +358,20 @@ def mock_requests(
 @pytest.fixture(autouse=True)
 def mock_all_requests(mock_requests):
     mock_requests()
+
+
+@pytest.fixture(autouse=True)
+def jwt_keys(app, mock_all_requests):
+    """
+    The keys are fetched when the app is set up, before the requests are
+    mocked: fetch the default issuer's mocked keys
+    """
+    app.jwt_key_store.refresh(app.config["OIDC"]["default"]["api_base_url"].rstrip("/"))
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(app):
+    app.access_token_cache.clear()
+    app.validated_claims_cache.clear()
+    app.refresh_token_expiration_cache.clear()
+    app.aggregate_response_cache.clear()
@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from wts.json_stream import parse_json_response, ResponseTooLargeError
+from wts.projection import Projection
+
+DOCUMENT = {
+    "authz": {
+        "/programs/a": [{"method": "read", "service": "*"}],
+        "/programs/b": [{"method": "write", "service": 'quote" and {[brackets'}],
+    },
+    "escaped": 'back\\slash\\"',
+    "role": "admin",
+    "is_admin": True,
+    "count": -1.5e3,
+    "nothing": None,
+    "name": "ünïcode",
+}
+
+
+def parse(body, projection=None, max_size=0, chunk_size=1, headers=None):
+    async def stream():
+        for i in range(0, len(body), chunk_size):
+            yield body[i : i + chunk_size]
+
+    response = httpx.Response(200, headers=headers, content=stream())
+    return asyncio.run(parse_json_response(response, projection, max_size))
+
+
+def test_parse_json_response_matches_projection():
+    """
+    Test that parsing a body received in chunks gives the same result as
+    projecting the parsed document.
+    """
+    for filters in [
+        None,
+        ["role"],
+        ["authz.*.*.service", "name", "missing"],
+        ["*"],
+        ["escaped"],
+    ]:
+        projection = Projection(filters) if filters else None
+        expected = projection.apply(DOCUMENT) if projection else DOCUMENT
+        body = json.dumps(DOCUMENT, ensure_ascii=False).encode()
+        for chunk_size in [1, 64, len(body)]:
+            assert parse(body, projection, chunk_size=chunk_size) == expected
+
+
+def test_parse_json_response_invalid_documents():
+    for body in [b"", b'{"a":1,}', b'{"a" 1}', b'{"a":1', b'{"a":1}}', b"{1:2}"]:
+        with pytest.raises(ValueError):
+            parse(body)
+
+
+def test_parse_json_response_max_size():
+    """
+    Test that the body is aborted once it is larger than the max size, and
+    that a larger `Content-Length` is rejected before reading the body.
+    """
+    read = []
+
+    async def stream():
+        for chunk in [b'{"a":', b'"long value"}', b"never read"]:
+            read.append(chunk)
+            yield chunk
+
+    response = httpx.Response(200, content=stream())
+    with pytest.raises(ResponseTooLargeError):
+        asyncio.run(parse_json_response(response, max_size=10))
+    assert len(read) == 2
+
+    body = b'{"a":"long value"}'
+    assert parse(body, max_size=len(body)) == {"a": "long value"}
+    with pytest.raises(ResponseTooLargeError):
+        parse(body, max_size=10, headers={"Content-Length": str(len(body))})
@@ -0,0 +1,75 @@
+import logging
+import threading
+
+from wts.jwt_keys import JWTKeyStore
+
+logger = logging.getLogger(__name__)
+
+
+class FakeIssuer(object):
+    """
+    Returns the issuer's current keys and records the requests.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.requests = []
+        self.fetched = threading.Event()
+
+    def __call__(self, issuer):
+        self.requests.append(issuer)
+        self.fetched.set()
+        return self.keys
+
+
+def test_key_store_prefetches_and_refreshes_unknown_keys():
+    issuer = "https://localhost/user"
+    fake_issuer = FakeIssuer({"key-01": "public key 1"})
+    store = JWTKeyStore(
+        [issuer], logger, min_refresh_interval=0, fetch_keys=fake_issuer
+    )
+    store.start()
+    try:
+        assert fake_issuer.requests == [issuer]
+        assert store.get_key(issuer, "key-01") == "public key 1"
+        assert len(fake_issuer.requests) == 1
+
+        # the issuer rotated its keys: the lookup does not wait for the new
+        # keys, which are fetched in the background
+        fake_issuer.keys = {"key-02": "public key 2"}
+        fake_issuer.fetched.clear()
+        assert store.get_key(issuer, "key-02") is None
+        assert fake_issuer.fetched.wait(5)
+        for _ in range(50):
+            if store.get_key(issuer, "key-02"):
+                break
+            fake_issuer.fetched.wait(0.1)
+        assert store.get_key(issuer, "key-02") == "public key 2"
+    finally:
+        store.stop()
+
+
+def test_key_store_refreshes_are_rate_limited():
+    issuer = "https://localhost/user"
+    fake_issuer = FakeIssuer({"key-01": "public key 1"})
+    store = JWTKeyStore(
+        [issuer], logger, min_refresh_interval=60, fetch_keys=fake_issuer
+    )
+    store.refresh_all()
+    for _ in range(10):
+        assert store.get_key(issuer, "unknown") is None
+    assert store._pending == set()
+
+
+def test_key_store_keeps_keys_when_refresh_fails():
+    issuer = "https://localhost/user"
+    fake_issuer = FakeIssuer({"key-01": "public key 1"})
+    store = JWTKeyStore([issuer], logger, fetch_keys=fake_issuer)
+    store.refresh_all()
+
+    def fail(issuer):
+        raise Exception("the issuer is down")
+
+    store.fetch_keys = fail
+    store.refresh_all()
+    assert store.get_key(issuer, "key-01") == "public key 1"
@@ -0,0 +1,361 @@
+from jose import jwk
+import jwt
+import kubernetes
+from kubernetes.client import V1ListMeta, V1ObjectMeta, V1Pod, V1PodList, V1PodStatus
+import logging
+import mock
+import time
+
+from wts.auth_plugins.k8s import PodIPIndex, PodLookupCache, PodUsernameResolver
+from wts.auth_plugins.service_account import ServiceAccountTokenVerifier
+from wts.jwt_keys import JWTKeyStore
+
+logger = logging.getLogger(__name__)
+
+
+def make_pod(uid, ip, username=None, phase="Running", resource_version="1", name=None):
+    annotations = {"gen3username": username} if username else None
+    return V1Pod(
+        metadata=V1ObjectMeta(
+            uid=uid,
+            name=name or uid,
+            annotations=annotations,
+            resource_version=resource_version,
+        ),
+        status=V1PodStatus(pod_ip=ip, phase=phase),
+    )
+
+
+class FakeWatch(object):
+    """
+    Replaces `kubernetes.watch.Watch`: streams the given events, then raises
+    `error` if provided.
+    """
+
+    def __init__(self, events, error=None):
+        self.events = events
+        self.error = error
+        self.stream_kwargs = None
+
+    def stream(self, func, **kwargs):
+        self.stream_kwargs = kwargs
+        for event in self.events:
+            yield event
+        if self.error:
+            raise self.error
+
+    def stop(self):
+        pass
+
+
+class FakePodLister(object):
+    def __init__(self, *pod_lists):
+        self.pod_lists = list(pod_lists)
+
+    def __call__(self, watch=False, **kwargs):
+        pods, resource_version = self.pod_lists.pop(0)
+        return V1PodList(
+            items=pods, metadata=V1ListMeta(resource_version=resource_version)
+        )
+
+
+def test_pod_ip_index_watch_events():
+    list_pods = FakePodLister(
+        ([make_pod("uid-1", "10.0.0.1", "user1"), make_pod("uid-2", "10.0.0.2")], "1")
+    )
+    events = [
+        {"type": "ADDED", "object": make_pod("uid-3", "10.0.0.3", "user3")},
+        # the pod gets a new IP
+        {"type": "MODIFIED", "object": make_pod("uid-1", "10.0.0.4", "user1")},
+        {"type": "DELETED", "object": make_pod("uid-2", "10.0.0.2")},
+        # the pod's IP is reused by a new pod once the pod is done
+        {
+            "type": "MODIFIED",
+            "object": make_pod("uid-3", "10.0.0.3", "user3", phase="Succeeded"),
+        },
+        {
+            "type": "ADDED",
+            "object": make_pod("uid-5", "10.0.0.3", "user5", resource_version="9"),
+        },
+    ]
+    watch = FakeWatch(
+        events, error=kubernetes.client.exceptions.ApiException(status=410)
+    )
+    index = PodIPIndex(list_pods, logger, watch_factory=lambda: watch)
+    index.sync_and_watch()
+
+    assert index.ready.is_set()
+    assert watch.stream_kwargs["resource_version"] == "1"
+    assert index.lookup("10.0.0.1") == (False, None)
+    assert index.lookup("10.0.0.4") == (True, "user1")
+    assert index.lookup("10.0.0.2") == (False, None)
+    assert index.lookup("10.0.0.3") == (True, "user5")
+
+
+def test_pod_ip_index_resyncs_when_watch_expires():
+    list_pods = FakePodLister(
+        ([make_pod("uid-1", "10.0.0.1", "user1")], "1"),
+        ([make_pod("uid-2", "10.0.0.2", "user2")], "5"),
+    )
+    watches = [
+        FakeWatch([], error=kubernetes.client.exceptions.ApiException(status=410)),
+        FakeWatch([], error=kubernetes.client.exceptions.ApiException(status=410)),
+    ]
+    index = PodIPIndex(list_pods, logger, watch_factory=lambda: watches.pop(0))
+
+    index.sync_and_watch()
+    assert index.lookup("10.0.0.1") == (True, "user1")
+
+    index.sync_and_watch()
+    assert index.lookup("10.0.0.1") == (False, None)
+    assert index.lookup("10.0.0.2") == (True, "user2")
+
+
+class FakeCoreV1Api(object):
+    """
+    Replaces `kubernetes.client.CoreV1Api`: lists the given pods, filtering on
+    the pod IP field selector, and records the calls.
+    """
+
+    def __init__(self, pods_by_namespace):
+        self.pods_by_namespace = pods_by_namespace
+        self.calls = []
+
+    def _list(self, pods, field_selector=None):
+        if field_selector:
+            ip = field_selector.split("=")[1]
+            pods = [pod for pod in pods if pod.status.pod_ip == ip]
+        return V1PodList(items=pods, metadata=V1ListMeta(resource_version="1"))
+
+    def list_pod_for_all_namespaces(self, field_selector=None, **kwargs):
+        self.calls.append(("all", kwargs.get("label_selector")))
+        pods = [p for pods in self.pods_by_namespace.values() for p in pods]
+        return self._list(pods, field_selector)
+
+    def list_namespaced_pod(self, namespace, field_selector=None, **kwargs):
+        self.calls.append((namespace, kwargs.get("label_selector")))
+        return self._list(self.pods_by_namespace.get(namespace, []), field_selector)
+
+    def read_namespaced_pod(self, name, namespace):
+        self.calls.append((namespace, name))
+        for pod in self.pods_by_namespace.get(namespace, []):
+            if pod.metadata.name == name:
+                return pod
+        raise kubernetes.client.exceptions.ApiException(status=404)
+
+
+def test_pod_username_resolver_caches_lookups():
+    core_v1 = FakeCoreV1Api({"jupyter-pods": [make_pod("uid-1", "10.0.0.1", "user1")]})
+    resolver = PodUsernameResolver(
+        core_v1, logger, cache=PodLookupCache(ttl=60, negative_ttl=60)
+    )
+    # a watch whose index doesn't know the IPs yet
+    index = PodIPIndex(FakePodLister(), logger, on_change=resolver.cache.invalidate)
+    resolver.indexes.append(index)
+
+    # unknown IPs are cached
+    assert resolver.get_username("10.0.0.9") is None
+    assert resolver.get_username("10.0.0.9") is None
+    assert len(core_v1.calls) == 1
+
+    # until a pod with this IP is added
+    new_pod = make_pod("uid-2", "10.0.0.9", "user2")
+    core_v1.pods_by_namespace["jupyter-pods"].append(new_pod)
+    index.apply_event({"type": "ADDED", "object": new_pod})
+    index.ready.set()
+    assert resolver.get_username("10.0.0.9") == "user2"
+    assert len(core_v1.calls) == 1
+
+
+def test_pod_username_resolver_ip_reuse():
+    """
+    Test that the usernames found by querying the kubernetes API are not
+    cached: the pod may go away while the query is in flight, and its IP be
+    reused by another user's pod before the index knows about it.
+    """
+    pod = make_pod("uid-1", "10.0.0.1", "user1")
+    core_v1 = FakeCoreV1Api({"jupyter-pods": [pod]})
+    resolver = PodUsernameResolver(
+        core_v1, logger, cache=PodLookupCache(ttl=60, negative_ttl=60)
+    )
+    index = PodIPIndex(FakePodLister(), logger, on_change=resolver.cache.invalidate)
+    resolver.indexes.append(index)
+    query_username = resolver.query_username
+
+    def query_username_then_delete_pod(ip):
+        username = query_username(ip)
+        # the DELETED event is applied while the query is in flight
+        index.apply_event({"type": "DELETED", "object": pod})
+        return username
+
+    with mock.patch.object(resolver, "query_username", query_username_then_delete_pod):
+        assert resolver.get_username("10.0.0.1") == "user1"
+
+    # a new pod reuses the IP, before its ADDED event is applied
+    core_v1.pods_by_namespace["jupyter-pods"] = [make_pod("uid-2", "10.0.0.1", "user2")]
+    assert resolver.get_username("10.0.0.1") == "user2"
+    assert len(core_v1.calls) == 2
+
+    # without the watch
+    resolver.indexes = []
+    core_v1.pods_by_namespace["jupyter-pods"] = [make_pod("uid-3", "10.0.0.1", "user3")]
+    assert resolver.get_username("10.0.0.1") == "user3"
+    assert len(core_v1.calls) == 3
+
+
+def test_pod_username_resolver_scoping():
+    core_v1 = FakeCoreV1Api(
+        {
+            "jupyter-pods": [make_pod("uid-1", "10.0.0.1", "user1")],
+            "argo": [make_pod("uid-2", "10.0.0.2", "user2")],
+            "default": [make_pod("uid-3", "10.0.0.3", "user3")],
+        }
+    )
+    resolver = PodUsernameResolver(
+        core_v1,
+        logger,
+        namespaces=["jupyter-pods", "argo"],
+        label_selector="app=workspace",
+    )
+    assert resolver.get_username("10.0.0.2") == "user2"
+    assert resolver.get_username("10.0.0.3") is None
+    assert ("all", "app=workspace") not in core_v1.calls
+    assert ("argo", "app=workspace") in core_v1.calls
+    assert all(namespace != "default" for namespace, _ in core_v1.calls)
+
+
+def test_pod_ip_index_invalidates_lookup_cache():
+    cache = PodLookupCache()
+    cache.set("10.0.0.1", None)
+    index = PodIPIndex(FakePodLister(), logger, on_change=cache.invalidate)
+    index.apply_event({"type": "ADDED", "object": make_pod("uid-1", "10.0.0.1", "u")})
+    assert cache.get("10.0.0.1") == (False, None)
+
+
+def test_token_endpoint_with_pod_ip_index(
+    app, client, test_user, persisted_refresh_tokens
+):
+    core_v1 = FakeCoreV1Api({})
+    list_pods = FakePodLister(
+        ([make_pod("uid-1", "10.0.0.1", test_user.username)], "1")
+    )
+    index = PodIPIndex(list_pods, logger)
+    index.resync()
+    resolver = PodUsernameResolver(core_v1, logger)
+    resolver.indexes.append(index)
+    app.pod_username_resolver = resolver
+    try:
+        res = client.get("/token/", environ_base={"REMOTE_ADDR": "10.0.0.1"})
+        assert res.status_code == 200
+        original_refresh_token = persisted_refresh_tokens["default"][0]["refresh_token"]
+        assert res.json["token"] == f"access_token_for_{original_refresh_token}"
+
+        # without a verifier, service account tokens are ignored and the pod
+        # is identified from its IP
+        assert app.service_account_token_verifier is None
+        res = client.get(
+            "/token/",
+            headers={app.config["K8S_SA_TOKEN_HEADER"]: "token"},
+            environ_base={"REMOTE_ADDR": "10.0.0.1"},
+        )
+        assert res.status_code == 200
+
+        # a pod without username annotation is not authenticated
+        index.apply_event({"type": "ADDED", "object": make_pod("uid-2", "10.0.0.2")})
+        res = client.get("/token/", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+        assert res.status_code == 403
+
+        # the kubernetes API was not queried
+        assert core_v1.calls == []
+    finally:
+        app.pod_username_resolver = None
+
+
+def make_service_account_token(private_key, kid, namespace, pod, **claims):
+    now = int(time.time())
+    claims = dict(
+        {
+            "iss": "https://kubernetes.default.svc",
+            "aud": ["wts"],
+            "iat": now,
+            "exp": now + 600,
+            "kubernetes.io": {
+                "namespace": namespace,
+                "pod": {"name": pod.metadata.name, "uid": pod.metadata.uid},
+                "serviceaccount": {"name": "default", "uid": "sa-uid"},
+            },
+        },
+        **claims,
+    )
+    return jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": kid})
+
+
+def test_token_endpoint_with_service_account_token(
+    app, client, test_user, persisted_refresh_tokens, rsa_private_key, rsa_public_key
+):
+    pod = make_pod("uid-1", "10.0.0.1", test_user.username, name="jupyter-test")
+    core_v1 = FakeCoreV1Api({"jupyter-pods": [pod]})
+    public_jwk = dict(jwk.construct(rsa_public_key, "RS256").to_dict(), kid="sa-key")
+    issuer = "https://kubernetes.default.svc"
+    jwks_requests = []
+
+    def fetch_keys(issuer):
+        jwks_requests.append(issuer)
+        return {public_jwk["kid"]: public_jwk}
+
+    # the key set is fetched before the first request; the store's background
+    # thread is not started, so that refreshes are only requested
+    key_store = JWTKeyStore(
+        [issuer], logger, min_refresh_interval=0, fetch_keys=fetch_keys
+    )
+    key_store.refresh_all()
+    app.pod_username_resolver = PodUsernameResolver(core_v1, logger)
+    app.service_account_token_verifier = ServiceAccountTokenVerifier(
+        key_store, "wts", issuer
+    )
+    header = app.config["K8S_SA_TOKEN_HEADER"]
+    try:
+        token = make_service_account_token(
+            rsa_private_key, "sa-key", "jupyter-pods", pod
+        )
+        # the request's IP doesn't matter
+        res = client.get(
+            "/token/", headers={header: token}, environ_base={"REMOTE_ADDR": "1.2.3.4"}
+        )
+        assert res.status_code == 200
+        original_refresh_token = persisted_refresh_tokens["default"][0]["refresh_token"]
+        assert res.json["token"] == f"access_token_for_{original_refresh_token}"
+
+        # the keys and the pod's username are cached
+        res = client.get("/token/", headers={header: token})
+        assert res.status_code == 200
+        assert len(jwks_requests) == 1
+        assert core_v1.calls == [("jupyter-pods", "jupyter-test")]
+
+        # tokens signed with an unknown key are rejected without fetching
+        # the key set during the request, and a refresh is requested
+        token = make_service_account_token(
+            rsa_private_key, "rotated-key", "jupyter-pods", pod
+        )
+        res = client.get("/token/", headers={header: token})
+        assert res.status_code == 403
+        assert len(jwks_requests) == 1
+        assert key_store._pending == {issuer}
+
+        # tokens for another audience are rejected
+        token = make_service_account_token(
+            rsa_private_key, "sa-key", "jupyter-pods", pod, aud=["other"]
+        )
+        res = client.get("/token/", headers={header: token})
+        assert res.status_code == 403
+
+        # tokens bound to a pod that was replaced are rejected
+        old_pod = make_pod("uid-0", "10.0.0.1", test_user.username, name="jupyter-test")
+        token = make_service_account_token(
+            rsa_private_key, "sa-key", "jupyter-pods", old_pod
+        )
+        res = client.get("/token/", headers={header: token})
+        assert res.status_code == 403
+    finally:
+        app.pod_username_resolver = None
+        app.service_account_token_verifier = None
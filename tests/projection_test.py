@@ -0,0 +1,64 @@
+import pytest
+from cdiserrors import UserError
+
+from wts.projection import Projection
+
+DOCUMENT = {
+    "username": "test",
+    "authz": {
+        "/open": [{"method": "read", "service": "*"}],
+        "/programs/a": [
+            {"method": "read", "service": "*"},
+            {"method": "write", "service": "fence"},
+        ],
+    },
+    "context": {"user": {"name": "test", "policies": ["p1"]}},
+}
+
+
+def test_projection_top_level_keys():
+    projection = Projection(["username", "missing"])
+    assert projection.apply(DOCUMENT) == {"username": "test", "missing": None}
+
+
+def test_projection_nested_paths():
+    projection = Projection(["context.user.name", "context.user.missing"])
+    assert projection.apply(DOCUMENT) == {
+        "context": {"user": {"name": "test", "missing": None}}
+    }
+    # a path through a value which is not an object
+    assert Projection(["username.first"]).apply(DOCUMENT) == {"username": None}
+
+
+def test_projection_wildcards():
+    projection = Projection(["authz.*.*.method"])
+    assert projection.apply(DOCUMENT) == {
+        "authz": {
+            "/open": [{"method": "read"}],
+            "/programs/a": [{"method": "read"}, {"method": "write"}],
+        }
+    }
+    assert Projection(["*"]).apply(DOCUMENT) == DOCUMENT
+
+
+def test_projection_merges_paths():
+    projection = Projection(
+        ["authz.*.*.method", "authz./programs/a", "username", "context.user.name"]
+    )
+    assert projection.apply(DOCUMENT) == {
+        "authz": {
+            "/open": [{"method": "read"}],
+            # the whole value is selected
+            "/programs/a": DOCUMENT["authz"]["/programs/a"],
+        },
+        "username": "test",
+        "context": {"user": {"name": "test"}},
+    }
+    assert Projection(["context", "context.user.name"]).apply(DOCUMENT) == {
+        "context": DOCUMENT["context"]
+    }
+
+
+def test_projection_invalid_path():
+    with pytest.raises(UserError):
+        Projection(["authz..method"])
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+
+from wts.singleflight import SingleFlight
+
+
+class ObservedSingleFlight(SingleFlight):
+    """
+    Lets tests wait until a number of callers have joined a call.
+    """
+
+    def __init__(self):
+        super(ObservedSingleFlight, self).__init__()
+        self.joined = threading.Semaphore(0)
+
+    def _join(self, key):
+        result = super(ObservedSingleFlight, self)._join(key)
+        self.joined.release()
+        return result
+
+    def wait_for_callers(self, count):
+        for _ in range(count):
+            assert self.joined.acquire(timeout=5)
+
+
+def test_concurrent_calls_are_coalesced():
+    single_flight = ObservedSingleFlight()
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def refresh():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "access_token"
+
+    results = []
+
+    def leader():
+        results.append(single_flight.do(("test", "idp_a"), refresh))
+
+    async def async_follower():
+        return await single_flight.do_async(("test", "idp_a"), asyncio.sleep, 0)
+
+    def follower():
+        results.append(single_flight.do(("test", "idp_a"), refresh))
+
+    threads = [threading.Thread(target=leader)]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=follower) for _ in range(5)]
+    threads.append(
+        threading.Thread(target=lambda: results.append(asyncio.run(async_follower())))
+    )
+    for thread in threads[1:]:
+        thread.start()
+    single_flight.wait_for_callers(len(threads))
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == ["access_token"] * 7
+
+    # once the call is done, a new call is made
+    assert single_flight.do(("test", "idp_a"), lambda: "new_access_token") == (
+        "new_access_token"
+    )
+
+
+def test_exceptions_are_shared_with_waiting_callers():
+    single_flight = ObservedSingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    async def refresh():
+        started.set()
+        await asyncio.get_running_loop().run_in_executor(None, release.wait, 5)
+        raise ValueError("fence is down")
+
+    errors = []
+
+    def caller(fn):
+        try:
+            fn()
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(
+        target=caller,
+        args=(lambda: asyncio.run(single_flight.do_async("key", refresh)),),
+    )
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(
+        target=caller, args=(lambda: single_flight.do("key", lambda: None),)
+    )
+    follower.start()
+    single_flight.wait_for_callers(2)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert len(errors) == 2
+    assert all(str(e) == "fence is down" for e in errors)
+
+
+def test_leader_cancellation_is_not_shared_with_waiting_callers():
+    single_flight = ObservedSingleFlight()
+    calls = []
+
+    async def refresh(duration):
+        calls.append(duration)
+        await asyncio.sleep(duration)
+        return "access_token"
+
+    async def run():
+        leader = asyncio.ensure_future(
+            asyncio.wait_for(single_flight.do_async("key", refresh, 5), 0.1)
+        )
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(
+            asyncio.wait_for(single_flight.do_async("key", refresh, 0.1), 5)
+        )
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    leader_result, follower_result = asyncio.run(run())
+
+    assert isinstance(leader_result, asyncio.TimeoutError)
+    # the follower made the call again instead of being cancelled
+    assert follower_result == "access_token"
+    assert calls == [5, 0.1]
+
+    # a synchronous follower retries too
+    single_flight = ObservedSingleFlight()
+    started = threading.Event()
+    results = []
+
+    async def cancelled_leader():
+        task = asyncio.ensure_future(single_flight.do_async("key", refresh, 5))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        task.cancel()
+
+    def leader():
+        asyncio.run(cancelled_leader())
+
+    def follower():
+        results.append(single_flight.do("key", lambda: "new_access_token"))
+
+    leader_thread = threading.Thread(target=leader)
+    leader_thread.start()
+    single_flight.wait_for_callers(1)
+    follower_thread = threading.Thread(target=follower)
+    follower_thread.start()
+    single_flight.wait_for_callers(1)
+    started.set()
+    leader_thread.join(5)
+    follower_thread.join(5)
+
+    assert results == ["new_access_token"]
@@ -0,0 +1,70 @@
+from cryptography.fernet import Fernet
+import jwt
+import time
+
+from wts.token_cache import MemoryAccessTokenCache, SQLiteAccessTokenCache
+
+
+def make_access_token(expires_in):
+    claims = {"exp": int(time.time()) + expires_in}
+    return jwt.encode(claims, key="secret", algorithm="HS256")
+
+
+def test_memory_cache_expiration_margin_and_min_lifetime():
+    cache = MemoryAccessTokenCache(max_size=10, margin=60)
+    access_token = make_access_token(600)
+    cache.set("test", "idp_a", access_token)
+    assert cache.get("test", "idp_a") == access_token
+    assert cache.get("test", "idp_a", min_lifetime=300) == access_token
+    assert cache.get("test", "idp_a", min_lifetime=3600) is None
+    assert cache.get("test", "default") is None
+
+    # tokens expiring within the safety margin are not cached
+    cache.set("test", "default", make_access_token(30))
+    assert cache.get("test", "default") is None
+
+    # tokens without an expiration are not cached
+    cache.set("test", "default", "not_a_jwt")
+    assert cache.get("test", "default") is None
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryAccessTokenCache(max_size=2, margin=60)
+    cache.set("user1", "default", make_access_token(600))
+    cache.set("user2", "default", make_access_token(600))
+    assert cache.get("user1", "default")
+    cache.set("user3", "default", make_access_token(600))
+    assert cache.get("user1", "default")
+    assert cache.get("user2", "default") is None
+    assert cache.get("user3", "default")
+
+
+def test_sqlite_cache_is_shared_and_encrypted(tmp_path):
+    path = str(tmp_path / "access_tokens.sqlite")
+    encryption_key = Fernet(Fernet.generate_key())
+    # each worker process creates its own cache object for the same file
+    worker_1_cache = SQLiteAccessTokenCache(path, encryption_key, margin=60)
+    worker_2_cache = SQLiteAccessTokenCache(path, encryption_key, margin=60)
+
+    access_token = make_access_token(600)
+    worker_1_cache.set("test", "idp_a", access_token)
+    assert worker_2_cache.get("test", "idp_a") == access_token
+    assert worker_2_cache.get("test", "idp_a", min_lifetime=3600) is None
+
+    with open(path, "rb") as f:
+        assert access_token.encode("utf-8") not in f.read()
+
+    worker_2_cache.invalidate("test", "idp_a")
+    assert worker_1_cache.get("test", "idp_a") is None
+
+
+def test_sqlite_cache_max_size(tmp_path):
+    path = str(tmp_path / "access_tokens.sqlite")
+    cache = SQLiteAccessTokenCache(path, Fernet(Fernet.generate_key()), max_size=2)
+    cache.set("user1", "default", make_access_token(300))
+    cache.set("user2", "default", make_access_token(600))
+    cache.set("user3", "default", make_access_token(900))
+    # the entry closest to its expiration is evicted first
+    assert cache.get("user1", "default") is None
+    assert cache.get("user2", "default")
+    assert cache.get("user3", "default")
@@ -4,15 +4,26 @@ from cryptography.fernet import Fernet
 import flask
 from flask import Flask
 from importlib import metadata
+import atexit
 import json
 from urllib.parse import urlparse, urljoin
 from cdislogging import get_logger
 from cdiserrors import APIError
+from concurrent.futures import ThreadPoolExecutor
 
+from .auth_plugins.k8s import create_pod_username_resolver
+from .auth_plugins.service_account import create_service_account_token_verifier
 from .blueprints import oauth2, tokens, external_oidc, aggregate
+from .events import RefreshTokenEvents
+from .http_client import AsyncHTTPClientPool, create_http_client
+from .jwt_keys import JWTKeyStore
 from .models import db, Base, RefreshToken
+from .response_cache import AggregateResponseCache
+from .token_cache import get_access_token_cache, RefreshTokenExpirationCache
+from .token_validation import TokenValidator, ValidatedClaimsCache
 from .utils import get_config_var as get_var
 from .version_data import VERSION, COMMIT
+from .worker_loop import worker_loop
 
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -39,6 +50,87 @@ def load_settings(app):
     OIDC_CLIENT_SECRET: client secret for the oidc client for this app
     AUTH_PLUGINS: a list of comma separate plugins, eg: k8s
     EXTERNAL_OIDC: config for additional oidc handshakes
+    AGGREGATE_ENDPOINT_CACHE_TTLS: number of seconds during which the
+        `/aggregate` responses are cached, for each endpoint of the
+        `AGGREGATE_ENDPOINT_ALLOWLIST`, eg: {"/user/user": 30}. Responses of
+        other endpoints are not cached
+    AGGREGATE_RESPONSE_CACHE_MAX_SIZE: max number of cached `/aggregate`
+        responses
+    AGGREGATE_RESPONSE_CACHE_MAX_BYTES: max total size of the cached
+        `/aggregate` responses, as JSON. The parsed responses take several
+        times more memory
+    AGGREGATE_TIMEOUT: max number of seconds to wait for the linked commons
+        to respond to `/aggregate` requests, or 0 to wait for all of them
+    AGGREGATE_ENDPOINT_TIMEOUTS: `AGGREGATE_TIMEOUT` overrides for specific
+        endpoints, eg: {"/authz/mapping": 3}
+    AGGREGATE_MAX_RESPONSE_SIZE: max number of bytes in the response of a
+        linked commons to an `/aggregate` request, or 0 for no limit. Larger
+        responses are returned as `null`
+    AGGREGATE_MAX_CONCURRENT_REQUESTS: max number of concurrent
+        `/aggregate` requests to each linked commons, or 0 for no limit
+    AGGREGATE_MAX_QUEUED_REQUESTS: max number of `/aggregate` requests
+        waiting for a concurrent request to the same commons to finish. The
+        commons is returned as `null` in the responses to other requests
+    ACCESS_TOKEN_CACHE_BACKEND: where to cache access tokens: "memory"
+        (per worker process) or "sqlite" (shared by the workers on a node)
+    ACCESS_TOKEN_CACHE_PATH: SQLite file for the "sqlite" cache backend
+    ACCESS_TOKEN_CACHE_MAX_SIZE: max number of cached access tokens
+    ACCESS_TOKEN_CACHE_EXPIRATION_MARGIN: number of seconds before their
+        expiration at which cached access tokens are evicted
+    REFRESH_TOKEN_EXPIRATION_CACHE_TTL: number of seconds during which the
+        expirations of a user's refresh tokens returned by `/external_oidc`
+        are cached. 0 to disable the cache
+    EXTERNAL_OIDC_STREAM_CHECK_INTERVAL: number of seconds between checks
+        of the refresh token expirations sent by `/external_oidc/stream`
+    EXTERNAL_OIDC_STREAM_MAX_DURATION: number of seconds after which
+        `/external_oidc/stream` streams are closed (clients reconnect)
+    EXTERNAL_OIDC_STREAM_MAX_CONNECTIONS: max number of open
+        `/external_oidc/stream` streams per worker. Default: 0, the
+        endpoint is disabled. In the ASGI mode, idle streams do not hold a
+        thread; otherwise each stream holds a worker thread, so it should
+        only be enabled with a threaded worker
+    VALIDATED_TOKEN_CACHE_MAX_SIZE: max number of validated JWTs whose
+        claims are cached until they expire, so they are only validated once.
+        0 to disable the cache
+    JWT_KEYS_REFRESH_INTERVAL: number of seconds between refreshes of the
+        token issuers' public keys, and of the cluster's service account
+        token keys
+    JWT_KEYS_MIN_REFRESH_INTERVAL: min number of seconds between refreshes
+        of an issuer's public keys when a token is signed with an unknown key
+    HTTP_CLIENT_MAX_CONNECTIONS: max number of connections in each pool of
+        connections to the IdPs
+    HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS: max number of idle connections
+        kept open in each pool
+    HTTP_CLIENT_KEEPALIVE_EXPIRY: number of seconds after which idle
+        connections are closed
+    HTTP_CLIENT_TIMEOUT: timeout in seconds for requests to the IdPs
+    HTTP_CLIENT_HTTP2: "true" to use HTTP/2 when the IdP supports it
+    DB_EXECUTOR_MAX_WORKERS: max number of threads running the database
+        queries of async views, such as `/aggregate`, outside of the event
+        loop
+    ASGI_EXECUTOR_MAX_WORKERS: max number of threads running the Flask
+        views in the ASGI mode (see `wts.asgi.ASGIApp`)
+    ASGI_MAX_QUEUED_REQUESTS: max number of requests waiting for one of these
+        threads, past which requests are answered with a 503 error
+    K8S_POD_NAMESPACES: namespaces in which to look for the requesting pods,
+        as a list or comma separated string. Default: all namespaces
+    K8S_POD_LABEL_SELECTOR: only look for requesting pods matching this label
+        selector
+    K8S_POD_CACHE_TTL: number of seconds during which the username of a pod
+        identified by its service account token is cached
+    K8S_POD_NEGATIVE_CACHE_TTL: number of seconds during which an IP that
+        doesn't match any pod is cached
+    K8S_POD_WATCH: "true" to resolve the pods' usernames from an in-memory
+        index kept up to date by watching the pods, instead of querying the
+        kubernetes API for each request
+    K8S_POD_WATCH_TIMEOUT: number of seconds after which the pod watch is
+        restarted
+    K8S_SA_TOKEN_AUDIENCE: audience of the projected service account tokens
+        pods can authenticate with. Service account token authentication is
+        disabled if not set
+    K8S_SA_TOKEN_ISSUER: issuer of the service account tokens. Default: the
+        cluster's service account issuer
+    K8S_SA_TOKEN_HEADER: header pods send their service account token in
     """
     app.secret_key = get_var("SECRET_KEY")
     app.encryption_key = Fernet(get_var("ENCRYPTION_KEY"))
@@ -73,6 +165,8 @@ def load_settings(app):
         "state_prefix": "",
     }
     app.config["OIDC"] = {"default": oauth_config}
+    # the default Fence, used to revoke tokens on logout
+    app.config["USER_API"] = fence_base_url.rstrip("/")
 
     for conf in get_var("EXTERNAL_OIDC", []):
         url = get_var("BASE_URL", secret_config=conf)
@@ -123,6 +217,101 @@ def load_settings(app):
     app.config["AGGREGATE_ENDPOINT_ALLOWLIST"] = [
         endpoint.rstrip("/") for endpoint in get_var("AGGREGATE_ENDPOINT_ALLOWLIST", [])
     ]
+    app.config["AGGREGATE_ENDPOINT_CACHE_TTLS"] = {
+        endpoint.rstrip("/"): int(ttl)
+        for endpoint, ttl in get_var("AGGREGATE_ENDPOINT_CACHE_TTLS", {}).items()
+    }
+    app.config["AGGREGATE_RESPONSE_CACHE_MAX_SIZE"] = int(
+        get_var("AGGREGATE_RESPONSE_CACHE_MAX_SIZE", 1000)
+    )
+    app.config["AGGREGATE_RESPONSE_CACHE_MAX_BYTES"] = int(
+        get_var("AGGREGATE_RESPONSE_CACHE_MAX_BYTES", 20000000)
+    )
+    app.config["AGGREGATE_TIMEOUT"] = float(get_var("AGGREGATE_TIMEOUT", 0))
+    app.config["AGGREGATE_MAX_RESPONSE_SIZE"] = int(
+        get_var("AGGREGATE_MAX_RESPONSE_SIZE", 0)
+    )
+    app.config["AGGREGATE_MAX_CONCURRENT_REQUESTS"] = int(
+        get_var("AGGREGATE_MAX_CONCURRENT_REQUESTS", 0)
+    )
+    app.config["AGGREGATE_MAX_QUEUED_REQUESTS"] = int(
+        get_var("AGGREGATE_MAX_QUEUED_REQUESTS", 0)
+    )
+    app.config["AGGREGATE_ENDPOINT_TIMEOUTS"] = {
+        endpoint.rstrip("/"): float(timeout)
+        for endpoint, timeout in get_var("AGGREGATE_ENDPOINT_TIMEOUTS", {}).items()
+    }
+    app.config["ACCESS_TOKEN_CACHE_BACKEND"] = get_var(
+        "ACCESS_TOKEN_CACHE_BACKEND", "memory"
+    )
+    app.config["ACCESS_TOKEN_CACHE_PATH"] = get_var(
+        "ACCESS_TOKEN_CACHE_PATH", "/tmp/wts_access_token_cache.sqlite"
+    )
+    app.config["ACCESS_TOKEN_CACHE_MAX_SIZE"] = int(
+        get_var("ACCESS_TOKEN_CACHE_MAX_SIZE", 1000)
+    )
+    app.config["ACCESS_TOKEN_CACHE_EXPIRATION_MARGIN"] = int(
+        get_var("ACCESS_TOKEN_CACHE_EXPIRATION_MARGIN", 60)
+    )
+    app.config["REFRESH_TOKEN_EXPIRATION_CACHE_TTL"] = int(
+        get_var("REFRESH_TOKEN_EXPIRATION_CACHE_TTL", 30)
+    )
+    app.config["EXTERNAL_OIDC_STREAM_CHECK_INTERVAL"] = int(
+        get_var("EXTERNAL_OIDC_STREAM_CHECK_INTERVAL", 15)
+    )
+    app.config["EXTERNAL_OIDC_STREAM_MAX_DURATION"] = int(
+        get_var("EXTERNAL_OIDC_STREAM_MAX_DURATION", 240)
+    )
+    app.config["EXTERNAL_OIDC_STREAM_MAX_CONNECTIONS"] = int(
+        get_var("EXTERNAL_OIDC_STREAM_MAX_CONNECTIONS", 0)
+    )
+    app.config["VALIDATED_TOKEN_CACHE_MAX_SIZE"] = int(
+        get_var("VALIDATED_TOKEN_CACHE_MAX_SIZE", 10000)
+    )
+    app.config["JWT_KEYS_REFRESH_INTERVAL"] = int(
+        get_var("JWT_KEYS_REFRESH_INTERVAL", 3600)
+    )
+    app.config["JWT_KEYS_MIN_REFRESH_INTERVAL"] = int(
+        get_var("JWT_KEYS_MIN_REFRESH_INTERVAL", 60)
+    )
+    app.config["HTTP_CLIENT_MAX_CONNECTIONS"] = int(
+        get_var("HTTP_CLIENT_MAX_CONNECTIONS", 100)
+    )
+    app.config["HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS"] = int(
+        get_var("HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS", 20)
+    )
+    app.config["HTTP_CLIENT_KEEPALIVE_EXPIRY"] = float(
+        get_var("HTTP_CLIENT_KEEPALIVE_EXPIRY", 60)
+    )
+    app.config["HTTP_CLIENT_TIMEOUT"] = float(get_var("HTTP_CLIENT_TIMEOUT", 5))
+    app.config["HTTP_CLIENT_HTTP2"] = (
+        str(get_var("HTTP_CLIENT_HTTP2", "false")).lower() == "true"
+    )
+    app.config["DB_EXECUTOR_MAX_WORKERS"] = int(get_var("DB_EXECUTOR_MAX_WORKERS", 4))
+    app.config["ASGI_EXECUTOR_MAX_WORKERS"] = int(
+        get_var("ASGI_EXECUTOR_MAX_WORKERS", 40)
+    )
+    app.config["ASGI_MAX_QUEUED_REQUESTS"] = int(
+        get_var("ASGI_MAX_QUEUED_REQUESTS", 160)
+    )
+    namespaces = get_var("K8S_POD_NAMESPACES", [])
+    if isinstance(namespaces, str):
+        namespaces = [n.strip() for n in namespaces.split(",") if n.strip()]
+    app.config["K8S_POD_NAMESPACES"] = namespaces
+    app.config["K8S_POD_LABEL_SELECTOR"] = get_var("K8S_POD_LABEL_SELECTOR", "")
+    app.config["K8S_POD_CACHE_TTL"] = int(get_var("K8S_POD_CACHE_TTL", 60))
+    app.config["K8S_POD_NEGATIVE_CACHE_TTL"] = int(
+        get_var("K8S_POD_NEGATIVE_CACHE_TTL", 10)
+    )
+    app.config["K8S_POD_WATCH"] = (
+        str(get_var("K8S_POD_WATCH", "false")).lower() == "true"
+    )
+    app.config["K8S_POD_WATCH_TIMEOUT"] = int(get_var("K8S_POD_WATCH_TIMEOUT", 300))
+    app.config["K8S_SA_TOKEN_AUDIENCE"] = get_var("K8S_SA_TOKEN_AUDIENCE", "")
+    app.config["K8S_SA_TOKEN_ISSUER"] = get_var("K8S_SA_TOKEN_ISSUER", "")
+    app.config["K8S_SA_TOKEN_HEADER"] = get_var(
+        "K8S_SA_TOKEN_HEADER", "X-Service-Account-Token"
+    )
     app.config["SESSION_COOKIE_NAME"] = "wts"
     app.config["SESSION_COOKIE_SECURE"] = True
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
@@ -151,11 +340,68 @@ def setup_app(app):
         idp: OAuth2Session(**conf) for idp, conf in app.config["OIDC"].items()
     }
     app.logger.info("Set up OIDC clients: {}".format(list(app.oauth2_clients.keys())))
+    # one connection pool per IdP, shared by all the token exchanges
+    app.http_clients = {
+        idp: create_http_client(app.config, app.logger) for idp in app.config["OIDC"]
+    }
+    # one connection pool per linked commons, shared by the `/aggregate`
+    # requests
+    app.async_http_clients = AsyncHTTPClientPool(app.config, app.logger, worker_loop)
+    atexit.register(app.async_http_clients.close)
+    # the connection pool allows 5 connections (plus overflow) per worker by
+    # default: keep the executor smaller so it cannot exhaust it
+    app.db_executor = ThreadPoolExecutor(
+        max_workers=app.config["DB_EXECUTOR_MAX_WORKERS"], thread_name_prefix="wts-db"
+    )
+    atexit.register(app.db_executor.shutdown, wait=False)
+    app.access_token_cache = get_access_token_cache(app.config, app.encryption_key)
+    app.logger.info(
+        "Set up {} access token cache".format(app.config["ACCESS_TOKEN_CACHE_BACKEND"])
+    )
+    app.refresh_token_expiration_cache = RefreshTokenExpirationCache(
+        ttl=app.config["REFRESH_TOKEN_EXPIRATION_CACHE_TTL"]
+    )
+    app.validated_claims_cache = ValidatedClaimsCache(
+        max_size=app.config["VALIDATED_TOKEN_CACHE_MAX_SIZE"]
+    )
+    # fetch the token issuers' keys now rather than during the first requests
+    issuers = {conf["api_base_url"].rstrip("/") for conf in app.config["OIDC"].values()}
+    app.jwt_key_store = JWTKeyStore(
+        sorted(issuers),
+        app.logger,
+        refresh_interval=app.config["JWT_KEYS_REFRESH_INTERVAL"],
+        min_refresh_interval=app.config["JWT_KEYS_MIN_REFRESH_INTERVAL"],
+    )
+    app.jwt_key_store.start()
+    # built once and shared by all requests, instead of reconfiguring the
+    # token validation for each request
+    app.token_validators = {
+        idp: TokenValidator(
+            conf["api_base_url"].rstrip("/"),
+            app.jwt_key_store,
+            app.validated_claims_cache,
+        )
+        for idp, conf in app.config["OIDC"].items()
+    }
+    app.external_oidc_providers = external_oidc.build_provider_snapshot()
+    app.refresh_token_events = RefreshTokenEvents(
+        max_subscriptions=app.config["EXTERNAL_OIDC_STREAM_MAX_CONNECTIONS"]
+    )
     app.logger.info(
         "Aggregate endpoint allowlist: {}".format(
             app.config["AGGREGATE_ENDPOINT_ALLOWLIST"]
         )
     )
+    app.aggregate_response_cache = AggregateResponseCache(
+        max_size=app.config["AGGREGATE_RESPONSE_CACHE_MAX_SIZE"],
+        max_bytes=app.config["AGGREGATE_RESPONSE_CACHE_MAX_BYTES"],
+    )
+    app.pod_username_resolver = create_pod_username_resolver(app.config, app.logger)
+    app.service_account_token_verifier = create_service_account_token_verifier(
+        app.config,
+        app.pod_username_resolver.core_v1 if app.pod_username_resolver else None,
+        app.logger,
+    )
     db.init_app(app)
     app.register_blueprint(oauth2.blueprint, url_prefix="/oauth2")
     app.register_blueprint(tokens.blueprint, url_prefix="/token")
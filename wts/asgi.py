@@ -0,0 +1,219 @@
+import asyncio
+import contextvars
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgiInstance
+
+from .worker_loop import worker_loop
+
+
+class AsyncResponseBody(object):
+    """
+    Lets a view, which runs in a thread, hand the body of its response over
+    to the ASGI server's event loop, so that a long-lived response such as
+    an event stream does not hold a thread while it is idle. See
+    `get_async_response_body`.
+
+    Args:
+        loop (asyncio.AbstractEventLoop): the server's event loop, in which
+            the body is sent
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.body = None
+        self.on_close = None
+
+    def set(self, body, on_close=None):
+        """
+        Args:
+            body: async generator of str, sent in `loop` after the body of
+                the view's response, which must be empty. It is closed once
+                sent or when the client disconnects
+            on_close (callable): optional, called once the body was sent or
+                the client disconnected
+        """
+        self.body = body
+        self.on_close = on_close
+
+
+current_async_response_body = contextvars.ContextVar(
+    "current_async_response_body", default=None
+)
+
+
+def get_async_response_body():
+    """
+    Return:
+        AsyncResponseBody: for the current request, or None if the app is not
+            served by `ASGIApp`
+    """
+    return current_async_response_body.get()
+
+
+class PooledWsgiToAsgiInstance(WsgiToAsgiInstance):
+    """
+    Runs the WSGI app in a thread of `executor`, instead of in a new thread
+    per request.
+    """
+
+    def __init__(self, wsgi_application, executor):
+        super().__init__(wsgi_application)
+        self.executor = executor
+
+    async def run_wsgi_app(self, body):
+        # the parent's method is wrapped by `sync_to_async`
+        run_wsgi_app = functools.partial(
+            WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, self
+        )
+        await sync_to_async(
+            run_wsgi_app, thread_sensitive=False, executor=self.executor
+        )(body)
+
+
+class ASGIApp(object):
+    """
+    ASGI application serving a Flask app, to run WTS with an ASGI server
+    such as uvicorn.
+
+    The Flask views run in a pool of `ASGI_EXECUTOR_MAX_WORKERS` threads
+    shared by all the requests, which wait for a thread once all of them are
+    busy. Past `ASGI_MAX_QUEUED_REQUESTS` waiting requests, requests are
+    answered with a 503 error. The async views (such as `/aggregate`) are run by asgiref in the
+    server's event loop, which is also used as the worker loop (see
+    `wts.worker_loop.WorkerLoop`) once the server has started: requests,
+    pooled HTTP clients and token fan-outs all share a single event loop per
+    worker process. Views can also send the body of their response from the
+    server's event loop, see `AsyncResponseBody`: such a response does not
+    count toward the limits once the view has returned.
+
+    Args:
+        app (flask.Flask): set up Flask app
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_workers = app.config["ASGI_EXECUTOR_MAX_WORKERS"]
+        self.max_queue = app.config["ASGI_MAX_QUEUED_REQUESTS"]
+        # requests running in or waiting for the executor
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="wts-asgi"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if self.pending >= self.max_workers + self.max_queue:
+            self.app.logger.warning(
+                "{} requests running and {} waiting, rejecting {}".format(
+                    self.max_workers, self.pending - self.max_workers, scope["path"]
+                )
+            )
+            await self.send_overloaded(send)
+            return
+        async_body = AsyncResponseBody(asyncio.get_running_loop())
+
+        async def send_wsgi_response(message):
+            # the async body follows the view's response
+            if (
+                async_body.body is not None
+                and message["type"] == "http.response.body"
+                and not message.get("more_body")
+            ):
+                return
+            await send(message)
+
+        token = current_async_response_body.set(async_body)
+        self.pending += 1
+        try:
+            await PooledWsgiToAsgiInstance(self.app, self.executor)(
+                scope, receive, send_wsgi_response
+            )
+        finally:
+            self.pending -= 1
+            current_async_response_body.reset(token)
+        # the thread was released
+        if async_body.body is not None:
+            await self.send_async_body(async_body, receive, send)
+
+    @staticmethod
+    async def send_overloaded(send):
+        body = json.dumps({"message": "Too many requests, try again later"}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def send_async_body(self, async_body, receive, send):
+        async def wait_for_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        body = async_body.body
+        disconnected = asyncio.ensure_future(wait_for_disconnect())
+        try:
+            while True:
+                next_chunk = asyncio.ensure_future(body.__anext__())
+                await asyncio.wait(
+                    [next_chunk, disconnected], return_when=asyncio.FIRST_COMPLETED
+                )
+                if not next_chunk.done():
+                    # the client is gone
+                    next_chunk.cancel()
+                    await asyncio.wait([next_chunk])
+                    return
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": chunk.encode("utf-8"),
+                        "more_body": True,
+                    }
+                )
+            await send({"type": "http.response.body"})
+        finally:
+            disconnected.cancel()
+            await body.aclose()
+            if async_body.on_close:
+                async_body.on_close()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        # the pooled clients are bound to the loop they were created in
+        await asyncio.to_thread(self.app.async_http_clients.close)
+        worker_loop.use(asyncio.get_running_loop())
+        self.app.logger.info("Using the ASGI server's event loop")
+
+    async def shutdown(self):
+        await asyncio.to_thread(self.app.async_http_clients.close)
+        worker_loop.stop()
+        self.executor.shutdown(wait=False)
@@ -1,9 +1,16 @@
 from .base import AccessTokenPlugin
 from .k8s import K8SPlugin
+from .service_account import ServiceAccountTokenPlugin
 import flask
 
 
 def find_user(allow_access_token=False):
     if allow_access_token and flask.request.headers.get("Authorization"):
         return AccessTokenPlugin().find_user()
+    # without a verifier, service account tokens cannot be checked: fall back
+    # to identifying the pod from its IP
+    if flask.current_app.service_account_token_verifier and flask.request.headers.get(
+        flask.current_app.config["K8S_SA_TOKEN_HEADER"]
+    ):
+        return ServiceAccountTokenPlugin().find_user()
     return K8SPlugin().find_user()
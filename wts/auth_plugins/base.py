@@ -1,8 +1,4 @@
-import flask
-
-from authutils.user import current_user
-
-from wts.utils import get_oauth_client
+from wts.token_validation import get_current_user
 
 
 class User(object):
@@ -20,15 +16,5 @@ class AccessTokenPlugin(object):
         find user identified in current request
         returns None if no user can be identified
         """
-        # `current_user` validates the token and relies on `OIDC_ISSUER`
-        # to know the issuer
-        default_oauth_client = get_oauth_client(idp="default")
-        flask.current_app.config["OIDC_ISSUER"] = default_oauth_client.metadata[
-            "api_base_url"
-        ].rstrip("/")
-        flask.current_app.config["USER_API"] = default_oauth_client.metadata[
-            "api_base_url"
-        ].rstrip("/")
-
-        user = current_user
+        user = get_current_user(idp="default")
         return User(userid=user.id, username=user.username)
@@ -1,5 +1,8 @@
+from collections import OrderedDict
 import flask
 import kubernetes
+import threading
+import time
 
 from .base import User
 
@@ -8,43 +11,442 @@ POD_USERNAME_ANNOTATION = "gen3username"
 # set by jupyterhub for jupyter pods
 JUPYTER_POD_ANNOTATION = "hub.jupyter.org/username"
 
+# pods in these phases are not running anymore, and their IP can be reused
+TERMINATED_POD_PHASES = ("Succeeded", "Failed")
+
+
+def get_username_from_pod(pod):
+    """
+    Args:
+        pod (kubernetes.client.V1Pod)
+
+    Return:
+        str: username from the pod's annotations, or None
+    """
+    annotations = pod.metadata.annotations
+    if annotations and POD_USERNAME_ANNOTATION in annotations:
+        return annotations[POD_USERNAME_ANNOTATION]
+    elif annotations and JUPYTER_POD_ANNOTATION in annotations:
+        return annotations[JUPYTER_POD_ANNOTATION]
+    return None
+
 
 def get_username_from_ip(ip):
-    flask.current_app.logger.debug("Getting username from IP {}".format(ip))
-    # Fail if we can't load kubernetes config...
-    try:
-        kubernetes.config.load_incluster_config()
-    except Exception:
+    resolver = flask.current_app.pod_username_resolver
+    # Fail if we couldn't load kubernetes config...
+    if not resolver:
         return None
-    v1 = kubernetes.client.CoreV1Api()
-    ret = v1.list_pod_for_all_namespaces(
-        field_selector="status.podIP={}".format(ip), watch=False
-    )
-    for pod in ret.items:
-        if (
-            pod.metadata.annotations
-            and POD_USERNAME_ANNOTATION in pod.metadata.annotations
-        ):
-            flask.current_app.logger.debug(
-                "Found username {} for IP {}".format(
-                    pod.metadata.annotations[POD_USERNAME_ANNOTATION], ip
+    return resolver.get_username(ip)
+
+
+class PodLookupCache(object):
+    """
+    TTL cache of pod IP to username lookups. Unknown IPs are cached too
+    ("negative" entries, username None), usually for a shorter time, so that
+    a misconfigured client calling repeatedly doesn't query the kubernetes
+    API for each request.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=10, max_size=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, ip):
+        """
+        Return:
+            tuple: (bool, str) whether the IP is cached, and the cached
+                username (None for a negative entry)
+        """
+        with self._lock:
+            entry = self._entries.get(ip)
+            if not entry:
+                return False, None
+            expires_at, username = entry
+            if expires_at <= time.time():
+                del self._entries[ip]
+                return False, None
+            return True, username
+
+    def set(self, ip, username):
+        ttl = self.ttl if username else self.negative_ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[ip] = (time.time() + ttl, username)
+            self._entries.move_to_end(ip)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, ip):
+        with self._lock:
+            self._entries.pop(ip, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class PodUsernameResolver(object):
+    """
+    Find the username of the pod with a given IP.
+
+    The kubernetes API is only queried for IPs that are neither in the
+    watch-backed pod IP indexes (if the pods are watched) nor in the lookup
+    cache, and the queries are limited to the configured namespaces and
+    label selector. Only the IPs that don't match any pod are cached: a pod
+    can go away and its IP be reused by another user's pod at any time,
+    including while the query is in flight, and before the indexes know
+    about it. The usernames of pods found by UID are cached, since UIDs are
+    never reused.
+
+    Args:
+        core_v1 (kubernetes.client.CoreV1Api): client created once at startup
+        logger: logger to use
+        namespaces (list, optional): only look for pods in these namespaces;
+            by default, look in all namespaces
+        label_selector (str, optional): only look for pods matching this
+            label selector
+        cache (PodLookupCache, optional)
+    """
+
+    def __init__(
+        self, core_v1, logger, namespaces=None, label_selector=None, cache=None
+    ):
+        self.core_v1 = core_v1
+        self.logger = logger
+        self.namespaces = namespaces or []
+        self.label_selector = label_selector or None
+        self.cache = cache or PodLookupCache()
+        self.indexes = []
+
+    def get_pod_listers(self):
+        """
+        Return:
+            list: (function, kwargs) tuples, one per scope in which to list
+                the pods
+        """
+        if not self.namespaces:
+            return [
+                (
+                    self.core_v1.list_pod_for_all_namespaces,
+                    {"label_selector": self.label_selector},
                 )
+            ]
+        return [
+            (
+                self.core_v1.list_namespaced_pod,
+                {"namespace": namespace, "label_selector": self.label_selector},
             )
-            return pod.metadata.annotations[POD_USERNAME_ANNOTATION]
-        elif (
-            pod.metadata.annotations
-            and JUPYTER_POD_ANNOTATION in pod.metadata.annotations
-        ):
-            flask.current_app.logger.debug(
-                "Found username {} for IP {}".format(
-                    pod.metadata.annotations[JUPYTER_POD_ANNOTATION], ip
-                )
+            for namespace in self.namespaces
+        ]
+
+    def start_watching(self, watch_timeout=300):
+        for list_pods, list_kwargs in self.get_pod_listers():
+            index = PodIPIndex(
+                list_pods,
+                self.logger,
+                list_kwargs=list_kwargs,
+                watch_timeout=watch_timeout,
+                on_change=self.cache.invalidate,
             )
-            return pod.metadata.annotations[JUPYTER_POD_ANNOTATION]
+            index.start()
+            self.indexes.append(index)
 
-    # No matching pod found
-    flask.current_app.logger.debug("No username found for IP {}".format(ip))
-    return None
+    def get_username(self, ip):
+        for index in self.indexes:
+            if index.ready.is_set():
+                found, username = index.lookup(ip)
+                if found:
+                    return username
+        found, username = self.cache.get(ip)
+        if found:
+            self.logger.debug("Found cached username {} for IP {}".format(username, ip))
+            return username
+        username = self.query_username(ip)
+        if username is None:
+            self.cache.set(ip, username)
+        return username
+
+    def get_username_for_pod(self, namespace, name, uid):
+        """
+        Find the username of a pod from its namespace, name and UID, for
+        example from the claims of the pod's service account token.
+        """
+        if self.namespaces and namespace not in self.namespaces:
+            self.logger.info("Pod {} is not in the configured namespaces".format(name))
+            return None
+        for index in self.indexes:
+            if index.ready.is_set():
+                found, username = index.lookup_pod(uid)
+                if found:
+                    return username
+        found, username = self.cache.get(uid)
+        if found:
+            return username
+        pod = None
+        try:
+            pod = self.core_v1.read_namespaced_pod(name, namespace)
+        except kubernetes.client.exceptions.ApiException as e:
+            if e.status != 404:
+                raise
+        username = None
+        # the pod may have been replaced by a new pod with the same name
+        if pod and pod.metadata.uid == uid:
+            username = get_username_from_pod(pod)
+        self.cache.set(uid, username)
+        return username
+
+    def query_username(self, ip):
+        self.logger.debug("Getting username from IP {}".format(ip))
+        for list_pods, list_kwargs in self.get_pod_listers():
+            ret = list_pods(
+                field_selector="status.podIP={}".format(ip), watch=False, **list_kwargs
+            )
+            for pod in ret.items:
+                username = get_username_from_pod(pod)
+                if username:
+                    self.logger.debug(
+                        "Found username {} for IP {}".format(username, ip)
+                    )
+                    return username
+
+        # No matching pod found
+        self.logger.debug("No username found for IP {}".format(ip))
+        return None
+
+
+class PodIPIndex(object):
+    """
+    In-memory index of pod IP to username, built from the pods' annotations.
+
+    The index is loaded by listing the pods, then kept up to date from the
+    events of a watch on the pods. When the watch's resource version expires
+    or the watch fails, the pods are listed again.
+
+    Args:
+        list_pods (callable): API method listing the pods, such as
+            `CoreV1Api.list_pod_for_all_namespaces`
+        logger: logger to use, since the watch runs outside of the app context
+        list_kwargs (dict, optional): keyword arguments for `list_pods`, such
+            as the namespace or label selector
+        watch_factory (callable): returns a `kubernetes.watch.Watch`-like
+            object whose `stream` method yields the watch events
+        watch_timeout (int): number of seconds after which the watch is
+            restarted from the last known resource version
+        retry_delay (int): number of seconds to wait before listing the pods
+            again after a failure
+        on_change (callable, optional): called with an IP when a pod with
+            this IP is added or removed
+    """
+
+    def __init__(
+        self,
+        list_pods,
+        logger,
+        list_kwargs=None,
+        watch_factory=kubernetes.watch.Watch,
+        watch_timeout=300,
+        retry_delay=5,
+        on_change=None,
+    ):
+        self.list_pods = list_pods
+        self.logger = logger
+        self.list_kwargs = list_kwargs or {}
+        self.on_change = on_change
+        self.watch_factory = watch_factory
+        self.watch_timeout = watch_timeout
+        self.retry_delay = retry_delay
+        self.ready = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # pod IP -> (pod UID, username or None)
+        self._pods_by_ip = {}
+        # pod UID -> pod IP, to find a pod's previous IP when it changes
+        self._ips_by_uid = {}
+
+    def lookup(self, ip):
+        """
+        Return:
+            tuple: (bool, str) whether the index knows a pod with this IP, and
+                the username for this pod (None if the pod is not annotated)
+        """
+        with self._lock:
+            entry = self._pods_by_ip.get(ip)
+        if not entry:
+            return False, None
+        return True, entry[1]
+
+    def lookup_pod(self, uid):
+        """
+        Return:
+            tuple: (bool, str) whether the index knows a pod with this UID,
+                and the username for this pod (None if the pod is not annotated)
+        """
+        with self._lock:
+            ip = self._ips_by_uid.get(uid)
+            entry = self._pods_by_ip.get(ip) if ip else None
+        if not entry:
+            return False, None
+        return True, entry[1]
+
+    def resync(self):
+        """
+        Rebuild the index from a list of all the pods.
+
+        Return:
+            str: resource version of the list, to start watching from
+        """
+        pods = self.list_pods(watch=False, **self.list_kwargs)
+        with self._lock:
+            changed_ips = set(self._pods_by_ip)
+            self._pods_by_ip = {}
+            self._ips_by_uid = {}
+            for pod in pods.items:
+                self._add_pod(pod)
+            changed_ips.update(self._pods_by_ip)
+        for ip in changed_ips:
+            self._notify(ip)
+        self.ready.set()
+        self.logger.info("Indexed the IPs of {} pods".format(len(pods.items)))
+        return pods.metadata.resource_version
+
+    def apply_event(self, event):
+        """
+        Update the index from a watch event.
+
+        Args:
+            event (dict): watch event, with the event "type" (ADDED, MODIFIED
+                or DELETED) and the V1Pod "object"
+        """
+        pod = event["object"]
+        with self._lock:
+            changed_ips = {self._remove_pod(pod)}
+            if event["type"] in ("ADDED", "MODIFIED"):
+                changed_ips.add(self._add_pod(pod))
+        for ip in changed_ips:
+            if ip:
+                self._notify(ip)
+
+    def _notify(self, ip):
+        if self.on_change:
+            self.on_change(ip)
+
+    def _add_pod(self, pod):
+        """
+        Return:
+            str: the pod's IP if it was added to the index
+        """
+        ip = pod.status.pod_ip if pod.status else None
+        phase = pod.status.phase if pod.status else None
+        if not ip or phase in TERMINATED_POD_PHASES:
+            return None
+        self._pods_by_ip[ip] = (pod.metadata.uid, get_username_from_pod(pod))
+        self._ips_by_uid[pod.metadata.uid] = ip
+        return ip
+
+    def _remove_pod(self, pod):
+        """
+        Return:
+            str: the pod's previous IP if it was in the index
+        """
+        ip = self._ips_by_uid.pop(pod.metadata.uid, None)
+        # the IP may already have been reused by another pod
+        if ip and self._pods_by_ip.get(ip, (None,))[0] == pod.metadata.uid:
+            del self._pods_by_ip[ip]
+        return ip
+
+    def sync_and_watch(self):
+        """
+        List the pods, then apply watch events until the resource version
+        expires. Return when the pods need to be listed again.
+        """
+        resource_version = self.resync()
+        while not self._stop.is_set():
+            watch = self.watch_factory()
+            try:
+                for event in watch.stream(
+                    self.list_pods,
+                    resource_version=resource_version,
+                    timeout_seconds=self.watch_timeout,
+                    **self.list_kwargs,
+                ):
+                    if event["type"] == "ERROR":
+                        self.logger.info(
+                            "Pod watch error, listing pods again: {}".format(
+                                event.get("raw_object")
+                            )
+                        )
+                        return
+                    self.apply_event(event)
+                    resource_version = event["object"].metadata.resource_version
+                    if self._stop.is_set():
+                        break
+            except kubernetes.client.exceptions.ApiException as e:
+                if e.status == 410:
+                    self.logger.info("Pod watch expired, listing pods again")
+                    return
+                raise
+            finally:
+                watch.stop()
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync_and_watch()
+            except Exception as e:
+                self.logger.error(
+                    "Failed to watch pods, retrying in {}s: {}".format(
+                        self.retry_delay, e
+                    )
+                )
+                self._stop.wait(self.retry_delay)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="pod-ip-index", daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+def create_pod_username_resolver(config, logger):
+    """
+    Create the `PodUsernameResolver` for the cluster WTS runs in, with a
+    kubernetes client that is reused by all the requests.
+
+    Args:
+        config (dict): app configuration
+        logger: logger to use
+
+    Return:
+        PodUsernameResolver: the resolver, or None if the kubernetes config
+            cannot be loaded
+    """
+    try:
+        kubernetes.config.load_incluster_config()
+    except Exception as e:
+        logger.info(
+            "Unable to load kubernetes config, pods cannot be authenticated: {}".format(
+                e
+            )
+        )
+        return None
+    resolver = PodUsernameResolver(
+        kubernetes.client.CoreV1Api(),
+        logger,
+        namespaces=config["K8S_POD_NAMESPACES"],
+        label_selector=config["K8S_POD_LABEL_SELECTOR"],
+        cache=PodLookupCache(
+            ttl=config["K8S_POD_CACHE_TTL"],
+            negative_ttl=config["K8S_POD_NEGATIVE_CACHE_TTL"],
+        ),
+    )
+    if config["K8S_POD_WATCH"]:
+        resolver.start_watching(watch_timeout=config["K8S_POD_WATCH_TIMEOUT"])
+    return resolver
 
 
 class K8SPlugin(object):
@@ -0,0 +1,149 @@
+import flask
+import json
+import kubernetes
+
+from jose import JWTError, jwt
+
+from ..jwt_keys import JWTKeyStore
+from .base import User
+
+# algorithms kubernetes can sign service account tokens with
+SERVICE_ACCOUNT_TOKEN_ALGORITHMS = ["RS256", "ES256"]
+
+
+class ServiceAccountTokenVerifier(object):
+    """
+    Verify projected service account tokens locally, using the cluster's
+    JSON Web Key Set.
+
+    The keys are looked up in `key_store`, which fetches them in the
+    background: verifying a token never calls the kubernetes API. A token
+    signed with an unknown key is rejected, and a refresh of the key set is
+    requested (see `wts.jwt_keys.JWTKeyStore`).
+
+    Args:
+        key_store (wts.jwt_keys.JWTKeyStore): store of the keys of `issuer`
+        audience (str): audience the tokens must be issued for
+        issuer (str): issuer of the tokens
+    """
+
+    def __init__(self, key_store, audience, issuer):
+        self.key_store = key_store
+        self.audience = audience
+        self.issuer = issuer
+
+    def verify(self, token):
+        """
+        Return:
+            dict: the token's claims
+
+        Raises:
+            jose.JWTError: if the token is not valid
+        """
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self.key_store.get_key(self.issuer, kid)
+        if key is None:
+            raise JWTError("unknown service account token key: {}".format(kid))
+        return jwt.decode(
+            token,
+            key,
+            algorithms=SERVICE_ACCOUNT_TOKEN_ALGORITHMS,
+            audience=self.audience,
+            issuer=self.issuer,
+        )
+
+
+def create_service_account_token_verifier(config, core_v1, logger):
+    """
+    Create the verifier for the projected service account tokens of the
+    cluster WTS runs in.
+
+    Args:
+        config (dict): app configuration
+        core_v1 (kubernetes.client.CoreV1Api): client whose credentials are
+            used to get the cluster's key set, or None if the kubernetes
+            config could not be loaded
+        logger: logger to use
+
+    Return:
+        ServiceAccountTokenVerifier: the verifier, or None if service account
+            token authentication is not configured
+    """
+    audience = config["K8S_SA_TOKEN_AUDIENCE"]
+    if not audience or not core_v1:
+        return None
+    timeout = config["HTTP_CLIENT_TIMEOUT"]
+
+    def fetch_keys(issuer):
+        # `_preload_content=False` because the client would not parse the
+        # key set as JSON
+        res = kubernetes.client.OpenidApi(
+            core_v1.api_client
+        ).get_service_account_issuer_open_id_keyset(
+            _preload_content=False, _request_timeout=timeout
+        )
+        return {key["kid"]: key for key in json.loads(res.data)["keys"]}
+
+    issuer = config["K8S_SA_TOKEN_ISSUER"]
+    if not issuer:
+        try:
+            res = kubernetes.client.WellKnownApi(
+                core_v1.api_client
+            ).get_service_account_issuer_open_id_configuration(
+                _preload_content=False, _request_timeout=timeout
+            )
+            issuer = json.loads(res.data)["issuer"]
+        except Exception as e:
+            logger.error(
+                "Unable to get the service account token issuer, service account "
+                "tokens will not be accepted: {}".format(e)
+            )
+            return None
+    logger.info(
+        "Verifying service account tokens issued by {} for {}".format(issuer, audience)
+    )
+    # fetch the key set now rather than during the first requests
+    key_store = JWTKeyStore(
+        [issuer],
+        logger,
+        refresh_interval=config["JWT_KEYS_REFRESH_INTERVAL"],
+        min_refresh_interval=config["JWT_KEYS_MIN_REFRESH_INTERVAL"],
+        fetch_keys=fetch_keys,
+    )
+    key_store.start()
+    return ServiceAccountTokenVerifier(key_store, audience, issuer)
+
+
+class ServiceAccountTokenPlugin(object):
+    """
+    Identify the requesting pod from the projected service account token it
+    sends in the `K8S_SA_TOKEN_HEADER` header, then get the username from
+    the pod's annotations.
+    """
+
+    def find_user(self):
+        verifier = flask.current_app.service_account_token_verifier
+        resolver = flask.current_app.pod_username_resolver
+        if not verifier or not resolver:
+            return None
+        token = flask.request.headers.get(
+            flask.current_app.config["K8S_SA_TOKEN_HEADER"]
+        )
+        try:
+            claims = verifier.verify(token)
+        except Exception as e:
+            flask.current_app.logger.info("Invalid service account token: {}".format(e))
+            return None
+
+        # projected tokens are bound to the pod they were issued for
+        k8s_claims = claims.get("kubernetes.io", {})
+        pod = k8s_claims.get("pod")
+        if not pod:
+            flask.current_app.logger.info("Service account token is not bound to a pod")
+            return None
+        username = resolver.get_username_for_pod(
+            k8s_claims.get("namespace"), pod.get("name"), pod.get("uid")
+        )
+        if not username:
+            return None
+        return User(userid=username, username=username)
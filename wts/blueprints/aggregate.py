@@ -1,16 +1,25 @@
 import asyncio
 import flask
 import httpx
+import json
+import queue
 import time
 from cdiserrors import NotFoundError, UserError
 
 from ..auth import authenticate
+from ..http_client import HostOverloadedError
+from ..json_stream import parse_json_response, ResponseTooLargeError
 from ..models import db, RefreshToken
+from ..projection import Projection
 from ..tokens import async_get_access_token
+from ..utils import run_db_query
+from ..worker_loop import worker_loop
 
 
 blueprint = flask.Blueprint("aggregate", __name__)
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+
 
 @blueprint.route("/<path:endpoint>", methods=["GET"])
 async def get_aggregate_response(endpoint):
@@ -22,12 +31,31 @@ async def get_aggregate_response(endpoint):
     fetched using the current user's refresh token.
 
     The size of the aggregated response body can be reduced by supplying a
-    `filters` parameter. If provided, only return JSON key-value pairs whose
-    key is in `filters`. Nested filters such as "toplevel.nested" are not yet
-    supported. Multiple filters can be specified:
+    `filters` parameter. If provided, only return the parts of each JSON
+    response selected by `filters`. Nested filters such as "toplevel.nested"
+    and wildcards such as "authz.*.method" are supported, see
+    `wts.projection.Projection`. Multiple filters can be specified:
 
     `GET /aggregate/user/user?filters=authz&filters=username`
 
+    If a TTL is configured for `endpoint` in `AGGREGATE_ENDPOINT_CACHE_TTLS`,
+    the response of each commons is cached per user, endpoint, parameters and
+    filters; the responses to unauthenticated requests are shared by all
+    callers. Commons whose response is cached are not queried, and no access
+    token is obtained for them. Failures to get a response are not cached.
+
+    Concurrent identical unauthenticated requests to a commons share a
+    single upstream request.
+
+    If a timeout is configured in `AGGREGATE_ENDPOINT_TIMEOUTS` or
+    `AGGREGATE_TIMEOUT`, the commons which did not respond in time are
+    returned as `null` and listed in the `X-Aggregate-Timed-Out` header.
+
+    When the request accepts `application/x-ndjson` or has a `format=ndjson`
+    parameter, the response is streamed as newline-delimited JSON, with one
+    `{commons_hostname: data}` record per commons, sent as soon as the
+    commons responds. See `stream_responses`.
+
     Args:
         endpoint (str): endpoint on each linked commons to proxy to
 
@@ -37,35 +65,249 @@ async def get_aggregate_response(endpoint):
     """
 
     # for `GET /aggregate/user/user`, flask sets endpoint to 'user/user'
-    endpoint = "/" + endpoint.rstrip("/")
+    endpoint = check_endpoint_allowed("/" + endpoint)
+
+    filters = flask.request.args.getlist("filters")
+    projection = Projection(filters) if filters else None
+    parameters = flask.request.args.to_dict()
+    parameters.pop("filters", None)
+    stream = flask.request.accept_mimetypes.best == NDJSON_MIMETYPE
+    # other `format` values are passed along to `endpoint`
+    if parameters.get("format") == "ndjson":
+        del parameters["format"]
+        stream = True
+
+    commons_hostnames = flask.current_app.config["COMMONS_HOSTNAMES"]
+    cache = flask.current_app.aggregate_response_cache
+    cache_ttl = flask.current_app.config["AGGREGATE_ENDPOINT_CACHE_TTLS"].get(
+        endpoint, 0
+    )
+    username = None
+    cached_responses = {}
+
+    if flask.request.headers.get("Authorization"):
+        authenticate(allow_access_token=True)
+        username = flask.g.user.username
+
+    if cache_ttl:
+        cached_responses = get_cached_responses(username, endpoint, parameters, filters)
+
+    refresh_tokens = await get_refresh_tokens(
+        username, [c for c in commons_hostnames if c not in cached_responses]
+    )
+
+    timeout = flask.current_app.config["AGGREGATE_ENDPOINT_TIMEOUTS"].get(
+        endpoint, flask.current_app.config["AGGREGATE_TIMEOUT"]
+    )
+    requests = {
+        commons: get_commons_response(
+            commons, refresh_token, endpoint, parameters, projection
+        )
+        for commons, refresh_token in refresh_tokens.items()
+    }
+
+    def cache_response(commons, data):
+        # failures are not cached
+        if cache_ttl and data is not None:
+            cache.set(username, commons, endpoint, parameters, filters, data, cache_ttl)
+
+    if stream:
+        return stream_responses(requests, timeout, cached_responses, cache_response)
+
+    responses, timed_out = await gather_responses(requests, timeout)
+    for commons, data in responses.items():
+        cache_response(commons, data)
+    responses.update(cached_responses)
+
+    response = flask.jsonify({c: responses[c] for c in commons_hostnames})
+    if timed_out:
+        response.headers["X-Aggregate-Timed-Out"] = ", ".join(timed_out)
+    return response
+
+
+@blueprint.route("", methods=["POST"])
+async def get_batch_aggregate_response():
+    """
+    Proxy GET requests to several endpoints on each linked commons and
+    return the aggregated responses of all the endpoints at once.
+
+    The request body is a list of the endpoints to query, each with the
+    optional `parameters` and `filters` of a `GET /aggregate` request:
+
+    `[{"endpoint": "/user/user", "filters": ["authz"]}, {"endpoint": "/authz/mapping"}]`
+
+    Each endpoint must be in the `AGGREGATE_ENDPOINT_ALLOWLIST` and can only
+    be requested once. The user is authenticated, their refresh tokens are
+    queried and an access token is obtained for each commons once for all
+    the endpoints, and all the requests run concurrently. The response
+    caching and timeouts are the same as for `GET /aggregate`, per endpoint.
+    The commons which did not respond in time are listed as
+    `<commons_hostname><endpoint>` in the `X-Aggregate-Timed-Out` header.
+
+    Return:
+        flask.wrappers.Response: `{endpoint: {commons_hostname: data}}` JSON
+            response
+    """
+    queries = parse_batch_request(flask.request.get_json(silent=True))
+
+    commons_hostnames = flask.current_app.config["COMMONS_HOSTNAMES"]
+    cache = flask.current_app.aggregate_response_cache
+    username = None
+    if flask.request.headers.get("Authorization"):
+        authenticate(allow_access_token=True)
+        username = flask.g.user.username
+
+    cached_responses = {}
+    for endpoint, parameters, filters, _ in queries:
+        if flask.current_app.config["AGGREGATE_ENDPOINT_CACHE_TTLS"].get(endpoint):
+            cached_responses[endpoint] = get_cached_responses(
+                username, endpoint, parameters, filters
+            )
+        else:
+            cached_responses[endpoint] = {}
+
+    # only query the database for the commons which are not all cached
+    refresh_tokens = await get_refresh_tokens(
+        username,
+        [
+            commons
+            for commons in commons_hostnames
+            if any(commons not in cached_responses[q[0]] for q in queries)
+        ],
+    )
+    access_tokens = AccessTokens(refresh_tokens)
+
+    async def get_endpoint_responses(endpoint, parameters, filters, projection):
+        timeout = flask.current_app.config["AGGREGATE_ENDPOINT_TIMEOUTS"].get(
+            endpoint, flask.current_app.config["AGGREGATE_TIMEOUT"]
+        )
+        requests = {
+            commons: get_commons_response_with_shared_token(
+                commons, access_tokens, endpoint, parameters, projection
+            )
+            for commons in commons_hostnames
+            if commons not in cached_responses[endpoint]
+        }
+        responses, timed_out = await gather_responses(requests, timeout)
+        cache_ttl = flask.current_app.config["AGGREGATE_ENDPOINT_CACHE_TTLS"].get(
+            endpoint, 0
+        )
+        for commons, data in responses.items():
+            # failures are not cached
+            if cache_ttl and data is not None:
+                cache.set(
+                    username, commons, endpoint, parameters, filters, data, cache_ttl
+                )
+        responses.update(cached_responses[endpoint])
+        return responses, timed_out
+
+    try:
+        results = await asyncio.gather(
+            *[get_endpoint_responses(*query) for query in queries]
+        )
+    finally:
+        access_tokens.cancel()
+
+    body = {}
+    all_timed_out = []
+    for (endpoint, _, _, _), (responses, timed_out) in zip(queries, results):
+        body[endpoint] = {c: responses[c] for c in commons_hostnames}
+        all_timed_out.extend(commons + endpoint for commons in timed_out)
+
+    response = flask.jsonify(body)
+    if all_timed_out:
+        response.headers["X-Aggregate-Timed-Out"] = ", ".join(all_timed_out)
+    return response
+
+
+def parse_batch_request(body):
+    """
+    Validate the body of a batch `POST /aggregate` request.
+
+    Return:
+        list: (endpoint(str), parameters(dict), filters(list),
+            projection(wts.projection.Projection)) tuples
+
+    Raises:
+        UserError: if the body is invalid
+        NotFoundError: if an endpoint is not in the allowlist
+    """
+    if not isinstance(body, list) or not body:
+        raise UserError("The request body must be a non-empty JSON list")
+    queries = []
+    for item in body:
+        if not isinstance(item, dict) or not isinstance(item.get("endpoint"), str):
+            raise UserError('Each requested item must have an "endpoint"')
+        parameters = item.get("parameters") or {}
+        if not isinstance(parameters, dict) or not all(
+            isinstance(value, str) for value in parameters.values()
+        ):
+            raise UserError('"parameters" must map parameter names to strings')
+        filters = item.get("filters") or []
+        if not isinstance(filters, list) or not all(
+            isinstance(f, str) for f in filters
+        ):
+            raise UserError('"filters" must be a list of strings')
+        endpoint = check_endpoint_allowed(item["endpoint"])
+        if endpoint in [q[0] for q in queries]:
+            raise UserError('Endpoint "{}" is requested twice'.format(endpoint))
+        projection = Projection(filters) if filters else None
+        queries.append((endpoint, parameters, filters, projection))
+    return queries
+
+
+def check_endpoint_allowed(endpoint):
+    """
+    Return:
+        str: `endpoint` without trailing slash
+
+    Raises:
+        NotFoundError: if `endpoint` is not in the allowlist
+    """
+    endpoint = endpoint.rstrip("/")
     if endpoint not in flask.current_app.config["AGGREGATE_ENDPOINT_ALLOWLIST"]:
         raise NotFoundError(
             "supplied endpoint is not configured in the Workspace Token Service aggregate endpoint allowlist"
         )
+    return endpoint
+
+
+def get_cached_responses(username, endpoint, parameters, filters):
+    """
+    Return:
+        dict: commons hostname to cached data, for the commons whose
+            response to this request is cached
+    """
+    # anonymous responses are cached with a `None` username, shared by all
+    # the unauthenticated requests
+    cache = flask.current_app.aggregate_response_cache
+    cached_responses = {}
+    for commons in flask.current_app.config["COMMONS_HOSTNAMES"]:
+        data = cache.get(username, commons, endpoint, parameters, filters)
+        if data is not None:
+            cached_responses[commons] = data
+    return cached_responses
 
-    filters = flask.request.args.getlist("filters")
-    parameters = flask.request.args.to_dict()
-    parameters.pop("filters", None)
 
+async def get_refresh_tokens(username, commons_hostnames):
+    """
+    Return:
+        dict: each of `commons_hostnames` to the user's refresh token for it,
+            or `None` if the request is anonymous or the user is not
+            connected to the commons
+    """
     # Initialzing refresh tokens with the keys of all the commons.
     # This is needed to treat requests to un-connected commons as open access requests
 
     # /!\ This does not support users being logged into more than 1 IDP for each Commons!!
     # https://ctds-planx.atlassian.net/browse/PXP-11324
-    refresh_tokens = {
-        commons: None for commons in flask.current_app.config["COMMONS_HOSTNAMES"]
-    }
+    refresh_tokens = {commons: None for commons in commons_hostnames}
 
-    if flask.request.headers.get("Authorization"):
-        authenticate(allow_access_token=True)
-        refresh_tokens_from_db = (
-            db.session.query(RefreshToken)
-            .filter_by(username=flask.g.user.username)
-            .filter(RefreshToken.expires > int(time.time()))
-            .order_by(RefreshToken.expires.asc())
+    if refresh_tokens and username:
+        # the query runs outside of the event loop, not to block it
+        refresh_tokens_from_db = await run_db_query(
+            get_unexpired_refresh_tokens, username
         )
-        # Release the db session as it is no longer needed
-        db.session.close()
 
         #  if a user has multiple refresh tokens for the same commons, we want
         #  the latest one to be used. see
@@ -74,38 +316,206 @@ async def get_aggregate_response(endpoint):
             {
                 flask.current_app.config["OIDC"][rt.idp]["commons_hostname"]: rt
                 for rt in refresh_tokens_from_db
+                if flask.current_app.config["OIDC"][rt.idp]["commons_hostname"]
+                in refresh_tokens
             }
         )
+    return refresh_tokens
+
+
+def get_unexpired_refresh_tokens(username):
+    """
+    Return:
+        list: the user's unexpired refresh tokens, from the one expiring
+            first to the one expiring last
+    """
+    return (
+        db.session.query(RefreshToken)
+        .filter_by(username=username)
+        .filter(RefreshToken.expires > int(time.time()))
+        .order_by(RefreshToken.expires.asc())
+        .all()
+    )
 
-        access_tokens = await asyncio.gather(
-            *[
-                async_get_access_token(refresh_token, commons_hostname)
-                for commons_hostname, refresh_token in refresh_tokens.items()
-            ]
+
+async def iter_responses(requests, timeout):
+    """
+    Run the `requests` concurrently, for at most `timeout` seconds, and yield
+    their results as they complete. The requests still running after
+    `timeout` seconds are cancelled.
+
+    Args:
+        requests (dict): commons hostname to coroutine returning a
+            (commons_hostname, data) tuple
+        timeout (float): max number of seconds to wait, or 0 to wait for all
+            the requests
+
+    Yield:
+        tuple: (commons_hostname(str), data(dict), timed_out(bool)), with
+            `data` being `None` for the commons which did not respond in time
+    """
+    tasks = {
+        asyncio.ensure_future(request): commons for commons, request in requests.items()
+    }
+    try:
+        for next_response in asyncio.as_completed(tasks, timeout=timeout or None):
+            try:
+                commons, data = await next_response
+            except asyncio.TimeoutError:
+                break
+            yield commons, data, False
+    finally:
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+    for task in pending:
+        flask.current_app.logger.error(
+            "No response from {} after {} seconds.".format(tasks[task], timeout)
         )
-        request_info = [
-            (commons, endpoint, {"Authorization": f"Bearer {access_token}"})
-            if access_token
-            else (commons, endpoint, {})
-            for commons, access_token in access_tokens
-        ]
-    else:
-        request_info = [
-            (commons, endpoint, {})
-            for commons in flask.current_app.config["COMMONS_HOSTNAMES"]
-        ]
-
-    commons_user_info = await asyncio.gather(
-        *[
-            make_request(commons, endpoint, headers, parameters, filters)
-            for commons, endpoint, headers in request_info
-        ]
+        yield tasks[task], None, True
+
+
+async def gather_responses(requests, timeout):
+    """
+    Run the `requests` concurrently, for at most `timeout` seconds. See
+    `iter_responses`.
+
+    Return:
+        tuple: (responses(dict), timed_out(list)), with `responses` mapping
+            each commons hostname to its data, `None` for the commons in
+            `timed_out` which did not respond in time
+    """
+    responses = {}
+    timed_out = []
+    async for commons, data, is_timed_out in iter_responses(requests, timeout):
+        responses[commons] = data
+        if is_timed_out:
+            timed_out.append(commons)
+    return responses, timed_out
+
+
+def stream_responses(requests, timeout, cached_responses, on_response):
+    """
+    Stream the responses of the commons as newline-delimited JSON, one
+    `{commons_hostname: data}` record per line, as soon as each commons
+    responds. The commons which did not respond in time are streamed as
+    `{commons_hostname: null, "timed_out": true}` records.
+
+    Flask closes the event loop of async views when they return, so the
+    `requests` run in `worker_loop` while the response is streamed.
+
+    Args:
+        requests (dict): see `iter_responses`
+        timeout (float): see `iter_responses`
+        cached_responses (dict): commons hostname to cached data, streamed
+            first
+        on_response (callable): called with each commons hostname and its
+            data once it responded
+
+    Return:
+        flask.wrappers.Response: NDJSON response
+    """
+    app = flask.current_app._get_current_object()
+    results = queue.Queue()
+
+    async def run_requests():
+        try:
+            with app.app_context():
+                async for result in iter_responses(requests, timeout):
+                    commons, data, _ = result
+                    on_response(commons, data)
+                    results.put(result)
+        finally:
+            results.put(None)
+
+    future = worker_loop.submit(run_requests())
+
+    def generate():
+        for commons, data in cached_responses.items():
+            yield json.dumps({commons: data}) + "\n"
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            commons, data, timed_out = result
+            record = {commons: data}
+            if timed_out:
+                record["timed_out"] = True
+            yield json.dumps(record) + "\n"
+
+    response = flask.Response(generate(), mimetype=NDJSON_MIMETYPE)
+    # stop querying the commons if the client goes away
+    response.call_on_close(future.cancel)
+    return response
+
+
+async def get_commons_response(
+    commons_hostname, refresh_token, endpoint, parameters, projection
+):
+    """
+    Get an access token using `refresh_token`, if any, and make a request to
+    `endpoint` on `commons_hostname` with it.
+
+    Return:
+        tuple: (commons_hostname(str), data(dict)), see `make_request`
+    """
+    _, access_token = await async_get_access_token(refresh_token, commons_hostname)
+    headers = {"Authorization": f"Bearer {access_token}"} if access_token else {}
+    return await make_request(
+        commons_hostname, endpoint, headers, parameters, projection
     )
 
-    return flask.jsonify({c: i for c, i in commons_user_info})
 
+class AccessTokens(object):
+    """
+    Access tokens for the commons, each obtained once for all the requests
+    to the commons. Only used from a single event loop.
 
-async def make_request(commons_hostname, endpoint, headers, parameters, filters):
+    Args:
+        refresh_tokens (dict): commons hostname to refresh token, see
+            `get_refresh_tokens`
+    """
+
+    def __init__(self, refresh_tokens):
+        self.refresh_tokens = refresh_tokens
+        self._tasks = {}
+
+    async def get(self, commons_hostname):
+        task = self._tasks.get(commons_hostname)
+        if task is None:
+            task = asyncio.ensure_future(
+                async_get_access_token(
+                    self.refresh_tokens[commons_hostname], commons_hostname
+                )
+            )
+            self._tasks[commons_hostname] = task
+        # a request timing out must not cancel the other requests' token
+        _, access_token = await asyncio.shield(task)
+        return access_token
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+
+async def get_commons_response_with_shared_token(
+    commons_hostname, access_tokens, endpoint, parameters, projection
+):
+    """
+    Same as `get_commons_response`, with an access token from
+    `access_tokens` (`AccessTokens`).
+    """
+    access_token = await access_tokens.get(commons_hostname)
+    headers = {"Authorization": f"Bearer {access_token}"} if access_token else {}
+    return await make_request(
+        commons_hostname, endpoint, headers, parameters, projection
+    )
+
+
+async def make_request(commons_hostname, endpoint, headers, parameters, projection):
     """
     Make an asychronous request to `endpoint` on `commons_hostname`.
 
@@ -114,11 +524,11 @@ async def make_request(commons_hostname, endpoint, headers, parameters, filters)
         endpoint (str): endpoint
         headers (dict): headers
         parameters (dict): parameters
-        filters (list): filters
+        projection (wts.projection.Projection): compiled `filters`, or None
 
     Return:
         tuple: (commons_hostname(str), data(dict)), with `data` being the response
-                body from `commons_hostname` after applying any `filters`
+                body from `commons_hostname` after applying any `projection`
     """
 
     # represent failure to get data with `null` JSON value (Python `None` will
@@ -128,12 +538,42 @@ async def make_request(commons_hostname, endpoint, headers, parameters, filters)
         return failure_indicator
     endpoint_url = f"https://{commons_hostname}{endpoint}"
 
+    http_clients = flask.current_app.async_http_clients
+    max_size = flask.current_app.config["AGGREGATE_MAX_RESPONSE_SIZE"]
+    # the response body is read in the worker loop, and aborted past `max_size`
+    # the response body is processed in the worker loop, while it is received
+    async def read_projected_json(response):
+        response.raise_for_status()
+        return await parse_json_response(response, projection, max_size)
+
     try:
-        async with httpx.AsyncClient() as client:
-            endpoint_response = await client.get(
-                endpoint_url, headers=headers, params=parameters
+        if headers:
+            data = await http_clients.stream(
+                commons_hostname,
+                endpoint_url,
+                read_projected_json,
+                headers=headers,
+                params=parameters,
             )
-            endpoint_response.raise_for_status()
+        else:
+            # the data is shared by the callers with the same projection
+            data = await http_clients.get_shared(
+                commons_hostname,
+                endpoint_url,
+                params=parameters,
+                handler=read_projected_json,
+                handler_key=projection.paths if projection else None,
+            )
+    except ResponseTooLargeError:
+        flask.current_app.logger.error(
+            "Response from {} is larger than {} bytes.".format(endpoint_url, max_size)
+        )
+        return failure_indicator
+    except HostOverloadedError as e:
+        flask.current_app.logger.error(
+            "Too many concurrent requests to {}: {}.".format(commons_hostname, e)
+        )
+        return failure_indicator
     except httpx.RequestError as e:
         flask.current_app.logger.error(
             "Failed to get response from {}.".format(e.request.url)
@@ -152,8 +592,4 @@ async def make_request(commons_hostname, endpoint, headers, parameters, filters)
         )
         return failure_indicator
 
-    data = endpoint_response.json()
-    if filters:
-        data = {f: data[f] if f in data else None for f in filters}
-
     return (commons_hostname, data)
@@ -1,17 +1,95 @@
+import asyncio
 import flask
+import hashlib
+import json
 import time
 
-from authutils.user import current_user
+from cdiserrors import AuthNError, NotFoundError, ServiceUnavailableError
 
+from sqlalchemy import func
+
+from ..asgi import get_async_response_body
 from ..models import db, RefreshToken
-from ..utils import get_config_var, get_oauth_client
+from ..token_validation import get_current_user
+from ..utils import get_config_var
 
 
 blueprint = flask.Blueprint("external_oidc", __name__)
 
 blueprint.route("")
 
-external_oidc_cache = {}
+
+class ProviderSnapshot(object):
+    """
+    The configured external identity providers, as listed by
+    `get_external_oidc`. Built once when the app is set up and never
+    modified afterwards, so requests can share it without copying it.
+
+    Each provider's JSON is serialized in advance: a response is built by
+    appending the user's refresh token expiration to the serialized
+    providers.
+
+    Args:
+        providers (list): providers, as dicts
+    """
+
+    def __init__(self, providers):
+        self.idps = tuple(p["idp"] for p in providers)
+        # each provider's JSON object, without the closing brace
+        self._fragments = tuple(
+            json.dumps(p, sort_keys=True, separators=(",", ":"))[:-1] for p in providers
+        )
+        self.digest = hashlib.sha256(
+            json.dumps(providers, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def to_json(self, idp_to_token_exp, unexpired_only=False):
+        """
+        Args:
+            idp_to_token_exp (dict): IdP to expiration of the user's refresh
+                token, or None
+            unexpired_only (bool): only list the IdPs for which the user has
+                an unexpired refresh token
+
+        Return:
+            str: the `{"providers": [...]}` JSON document
+        """
+        providers = [
+            '{},"refresh_token_expiration":{}}}'.format(
+                fragment, json.dumps(idp_to_token_exp[idp])
+            )
+            for idp, fragment in zip(self.idps, self._fragments)
+            if idp_to_token_exp[idp] or not unexpired_only
+        ]
+        return '{{"providers":[{}]}}'.format(",".join(providers))
+
+
+def build_provider_snapshot():
+    """
+    Return:
+        ProviderSnapshot: the identity providers configured in `EXTERNAL_OIDC`
+    """
+    return ProviderSnapshot(
+        [
+            {
+                # name to display on the login button
+                "name": idp_conf["name"],
+                # unique ID of the configured identity provider
+                "idp": idp,
+                # hostname URL - gen3fuse uses it to get the manifests
+                "base_url": oidc_conf["base_url"],
+                # authorization URL to use for logging in
+                "urls": [
+                    {
+                        "name": idp_conf["name"],
+                        "url": generate_authorization_url(idp),
+                    }
+                ],
+            }
+            for oidc_conf in get_config_var("EXTERNAL_OIDC", [])
+            for idp, idp_conf in oidc_conf.get("login_options", {}).items()
+        ]
+    )
 
 
 # this is called every 10 sec by the Gen3Fuse sidecar
@@ -30,44 +108,19 @@ def get_external_oidc():
     of the Fence "/login" endpoint, and so that we can implement a more
     complex "login options" logic in the future (automatically get the
     available login options for each IdP, which could include dropdowns).
+
+    The response has an ETag: if the client sends it back in an
+    "If-None-Match" header and the response did not change, an empty
+    304 response is returned.
     """
 
     unexpired_only = flask.request.args.get("unexpired", "false").lower() == "true"
+    snapshot = flask.current_app.external_oidc_providers
 
-    global external_oidc_cache
-    if not external_oidc_cache:
-        data = {
-            "providers": [
-                {
-                    # name to display on the login button
-                    "name": idp_conf["name"],
-                    # unique ID of the configured identity provider
-                    "idp": idp,
-                    # hostname URL - gen3fuse uses it to get the manifests
-                    "base_url": oidc_conf["base_url"],
-                    # authorization URL to use for logging in
-                    "urls": [
-                        {
-                            "name": idp_conf["name"],
-                            "url": generate_authorization_url(idp),
-                        }
-                    ],
-                }
-                for oidc_conf in get_config_var("EXTERNAL_OIDC", [])
-                for idp, idp_conf in oidc_conf.get("login_options", {}).items()
-            ]
-        }
-        external_oidc_cache = data
-
-    # get the username of the current logged in user.
-    # `current_user` validates the token and relies on `OIDC_ISSUER`
-    # to know the issuer
-    client = get_oauth_client(idp="default")
-    flask.current_app.config["OIDC_ISSUER"] = client.metadata["api_base_url"].strip("/")
-    flask.current_app.config["USER_API"] = client.metadata["api_base_url"].rstrip("/")
+    # get the username of the current logged in user
     username = None
     try:
-        user = current_user
+        user = get_current_user(idp="default")
         username = user.username
     except Exception:
         flask.current_app.logger.info(
@@ -75,19 +128,154 @@ def get_external_oidc():
         )
 
     # get all expirations at once (1 DB query)
-    idp_to_token_exp = get_refresh_token_expirations(
-        username, [p["idp"] for p in external_oidc_cache["providers"]]
+    idp_to_token_exp = get_refresh_token_expirations(username, snapshot.idps)
+
+    etag = get_etag(snapshot, idp_to_token_exp, unexpired_only)
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        response = flask.current_app.response_class(
+            snapshot.to_json(idp_to_token_exp, unexpired_only),
+            mimetype="application/json",
+        )
+    response.set_etag(etag)
+    # the response depends on the user: shared caches must not reuse it
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Authorization")
+    return response
+
+
+@blueprint.route("/stream", methods=["GET"])
+def stream_external_oidc():
+    """
+    Stream the `get_external_oidc` response of the currently logged in user
+    as Server-Sent Events, instead of polling it. "unexpired=true" is
+    supported.
+
+    A "providers" event, whose data is the response, is sent when the
+    stream is opened, then each time the response changes: when one of the
+    user's refresh tokens is linked or replaced, or when an expiration
+    changes (e.g. from "2 days" to "1 days"). Changes are checked every
+    `EXTERNAL_OIDC_STREAM_CHECK_INTERVAL` seconds, and immediately for the
+    refresh tokens linked through this worker; a comment line is sent when
+    nothing changed, to keep the connection alive.
+
+    The stream is closed after `EXTERNAL_OIDC_STREAM_MAX_DURATION` seconds.
+    Clients reconnect automatically, sending the ID of the last event they
+    received in the "Last-Event-ID" header, so an unchanged response is not
+    sent again.
+
+    When the app is served by `wts.asgi.ASGIApp`, the events are sent from
+    the server's event loop: an idle stream does not hold a thread. Otherwise,
+    each open stream holds a worker thread.
+    """
+    config = flask.current_app.config
+    if not config["EXTERNAL_OIDC_STREAM_MAX_CONNECTIONS"]:
+        raise NotFoundError("Streaming is not enabled")
+    unexpired_only = flask.request.args.get("unexpired", "false").lower() == "true"
+    snapshot = flask.current_app.external_oidc_providers
+    try:
+        username = get_current_user(idp="default").username
+    except Exception:
+        raise AuthNError("user is not logged in")
+
+    async_body = get_async_response_body()
+    subscription = flask.current_app.refresh_token_events.subscribe(
+        username, loop=async_body.loop if async_body else None
     )
+    if not subscription:
+        raise ServiceUnavailableError("Too many open streams, try again later")
+
+    app = flask.current_app._get_current_object()
+    check_interval = config["EXTERNAL_OIDC_STREAM_CHECK_INTERVAL"]
+    max_duration = config["EXTERNAL_OIDC_STREAM_MAX_DURATION"]
+    # wait for the check interval before reconnecting
+    retry = "retry: {}\n\n".format(check_interval * 1000)
+
+    def next_event(last_event_id):
+        """
+        Return:
+            tuple: (event ID, event to send): the providers if they changed
+                since `last_event_id`, a keep-alive comment otherwise
+        """
+        idp_to_token_exp = get_refresh_token_expirations(username, snapshot.idps)
+        event_id = get_etag(snapshot, idp_to_token_exp, unexpired_only)
+        if event_id == last_event_id:
+            return event_id, ": keep-alive\n\n"
+        return event_id, "event: providers\nid: {}\ndata: {}\n\n".format(
+            event_id, snapshot.to_json(idp_to_token_exp, unexpired_only)
+        )
+
+    def generate_events(last_event_id):
+        try:
+            deadline = time.time() + max_duration
+            yield retry
+            while True:
+                last_event_id, event = next_event(last_event_id)
+                yield event
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                subscription.wait(min(check_interval, remaining))
+        finally:
+            subscription.close()
+
+    def next_event_in_app_context(last_event_id):
+        with app.app_context():
+            return next_event(last_event_id)
+
+    async def generate_events_async(last_event_id):
+        # runs in the server's event loop: the database is queried in the
+        # app's database executor, not to block it
+        loop = asyncio.get_running_loop()
+        try:
+            deadline = time.time() + max_duration
+            yield retry
+            while True:
+                last_event_id, event = await loop.run_in_executor(
+                    app.db_executor, next_event_in_app_context, last_event_id
+                )
+                yield event
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                await subscription.wait_async(min(check_interval, remaining))
+        finally:
+            subscription.close()
+
+    last_event_id = flask.request.headers.get("Last-Event-ID")
+    if async_body:
+        async_body.set(
+            generate_events_async(last_event_id), on_close=subscription.close
+        )
+        response = flask.Response(iter(()), mimetype="text/event-stream")
+    else:
+        response = flask.Response(
+            flask.stream_with_context(generate_events(last_event_id)),
+            mimetype="text/event-stream",
+        )
+        # in case the client disconnects before the stream starts
+        response.call_on_close(subscription.close)
+    response.headers["Cache-Control"] = "no-cache"
+    # ask nginx not to buffer the events
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
 
-    result = {"providers": []}
-    for p in external_oidc_cache["providers"]:
-        # expiration of the current user's refresh token
-        exp = idp_to_token_exp[p["idp"]]
-        if exp or not unexpired_only:
-            p["refresh_token_expiration"] = exp
-            result["providers"].append(p)
+def get_etag(snapshot, idp_to_token_exp, unexpired_only):
+    """
+    The `get_external_oidc` response only depends on the configured
+    providers and on the user's expirations: if they did not change, the
+    client's copy is up to date.
 
-    return flask.jsonify(result), 200
+    Return:
+        str: strong ETag of the response
+    """
+    return hashlib.sha256(
+        json.dumps(
+            [snapshot.digest, unexpired_only, idp_to_token_exp], sort_keys=True
+        ).encode("utf-8")
+    ).hexdigest()
 
 
 def generate_authorization_url(idp):
@@ -124,26 +312,42 @@ def get_refresh_token_expirations(username, idps):
     Returns:
         dict: IdP to expiration of the most recent refresh token, or None if it's expired.
     """
+    now = int(time.time())
+    timestamps = get_refresh_token_expiration_timestamps(username, idps)
+    return {
+        idp: seconds_to_human_time(timestamps[idp] - now) if timestamps[idp] else None
+        for idp in idps
+    }
+
+
+def get_refresh_token_expiration_timestamps(username, idps):
+    """
+    The expirations are read from `flask.current_app.refresh_token_expiration_cache`
+    if the user's expirations were recently queried.
+
+    Returns:
+        dict: IdP to expiration timestamp of the most recent refresh token,
+            or None if there is no refresh token for this IdP
+    """
+    if not username:
+        return {idp: None for idp in idps}
+    cache = flask.current_app.refresh_token_expiration_cache
+    expirations = cache.get(username)
+    if expirations is not None and all(idp in expirations for idp in idps):
+        return expirations
+
     try:
-        now = int(time.time())
-        refresh_tokens = (
-            db.session.query(RefreshToken)
+        # only the most recent expiration per IdP, read from the
+        # (username, idp, expires) index, not the whole refresh token rows
+        most_recent_expirations = (
+            db.session.query(RefreshToken.idp, func.max(RefreshToken.expires))
             .filter_by(username=username)
             .filter(RefreshToken.idp.in_(idps))
-            .order_by(RefreshToken.expires.asc())
+            .group_by(RefreshToken.idp)
         )
-        if not refresh_tokens:
-            return {}
-        # the tokens are ordered by oldest to most recent, because we only want
-        # to return None if the most recent token is expired
         expirations = {idp: None for idp in idps}
-        expirations.update(
-            {
-                t.idp: seconds_to_human_time(t.expires - now)
-                for t in refresh_tokens
-                if t.expires > now
-            }
-        )
-        return expirations
+        expirations.update(dict(most_recent_expirations))
     finally:
         db.session.close()
+    cache.set(username, expirations)
+    return expirations
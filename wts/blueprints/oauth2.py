@@ -3,10 +3,10 @@ import flask
 from authlib.common.security import generate_token
 from urllib.parse import urljoin
 
-from authutils.user import current_user
 from cdiserrors import APIError, UserError, AuthNError, AuthZError
 
 from ..resources import oauth2
+from ..token_validation import get_current_user
 from ..utils import get_oauth_client
 
 
@@ -19,14 +19,8 @@ def connected():
     Check if user is connected and has a valid token
     """
     requested_idp = flask.request.args.get("idp", "default")
-    # `current_user` validates the token and relies on `OIDC_ISSUER`
-    # to know the issuer
-    client = get_oauth_client(idp=requested_idp)
-    flask.current_app.config["OIDC_ISSUER"] = client.metadata["api_base_url"].strip("/")
-    flask.current_app.config["USER_API"] = client.metadata["api_base_url"].rstrip("/")
-
     try:
-        user = current_user
+        user = get_current_user(idp=requested_idp)
         flask.current_app.logger.info(user)
         username = user.username
     except Exception:
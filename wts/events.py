@@ -0,0 +1,116 @@
+import asyncio
+import threading
+
+
+class Subscription(object):
+    """
+    A client's subscription to the changes of a user's refresh tokens.
+
+    Args:
+        events (RefreshTokenEvents)
+        username (str)
+        loop (asyncio.AbstractEventLoop): optional, event loop in which
+            `wait_async` is used
+    """
+
+    def __init__(self, events, username, loop=None):
+        self.events = events
+        self.username = username
+        self.loop = loop
+        self._changed = threading.Event()
+        self._async_changed = asyncio.Event() if loop else None
+
+    def wait(self, timeout):
+        """
+        Wait until the user's refresh tokens change, or until `timeout`
+        seconds have passed.
+
+        Return:
+            bool: whether the refresh tokens changed
+        """
+        changed = self._changed.wait(timeout)
+        self._changed.clear()
+        return changed
+
+    async def wait_async(self, timeout):
+        """
+        Same as `wait`, without blocking the subscription's event loop.
+        """
+        try:
+            await asyncio.wait_for(self._async_changed.wait(), timeout)
+            changed = True
+        except asyncio.TimeoutError:
+            changed = False
+        self._async_changed.clear()
+        return changed
+
+    def notify(self):
+        self._changed.set()
+        if self.loop:
+            try:
+                self.loop.call_soon_threadsafe(self._async_changed.set)
+            except RuntimeError:
+                # the loop is closed
+                pass
+
+    def close(self):
+        self.events.unsubscribe(self)
+
+
+class RefreshTokenEvents(object):
+    """
+    In-process publish/subscribe of the changes of users' refresh tokens.
+
+    Only the changes made by this worker process are published: subscribers
+    should also check the refresh tokens periodically to get the changes
+    made by other workers.
+
+    Args:
+        max_subscriptions (int): max number of open subscriptions
+    """
+
+    def __init__(self, max_subscriptions=100):
+        self.max_subscriptions = max_subscriptions
+        self._subscriptions = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, username, loop=None):
+        """
+        Args:
+            username (str)
+            loop (asyncio.AbstractEventLoop): optional, see `Subscription`
+
+        Return:
+            Subscription: to close once the client is gone, or None if
+                there are already `max_subscriptions` open subscriptions
+        """
+        subscription = Subscription(self, username, loop)
+        with self._lock:
+            if self._count >= self.max_subscriptions:
+                return None
+            self._subscriptions.setdefault(username, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.username, set())
+            if subscription in subscriptions:
+                subscriptions.discard(subscription)
+                self._count -= 1
+            if not subscriptions:
+                self._subscriptions.pop(subscription.username, None)
+
+    def publish(self, username):
+        """
+        Notify the subscribers that the user's refresh tokens changed.
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(username, ()))
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def count(self):
+        with self._lock:
+            return self._count
@@ -0,0 +1,242 @@
+import asyncio
+import httpx
+import os
+import threading
+
+
+def get_http_client_kwargs(config, logger):
+    """
+    Build the `httpx.Client` / `httpx.AsyncClient` connection pool settings
+    from the app configuration.
+
+    Args:
+        config (dict): app configuration
+        logger: logger to warn about unavailable optional features
+
+    Return:
+        dict: keyword arguments for the httpx client
+    """
+    http2 = config["HTTP_CLIENT_HTTP2"]
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning(
+                "HTTP/2 is enabled but the 'h2' package is not installed: "
+                "falling back to HTTP/1.1. Install 'httpx[http2]' to use HTTP/2"
+            )
+            http2 = False
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=config["HTTP_CLIENT_MAX_CONNECTIONS"],
+            max_keepalive_connections=config["HTTP_CLIENT_MAX_KEEPALIVE_CONNECTIONS"],
+            keepalive_expiry=config["HTTP_CLIENT_KEEPALIVE_EXPIRY"],
+        ),
+        "timeout": httpx.Timeout(config["HTTP_CLIENT_TIMEOUT"]),
+    }
+
+
+def create_http_client(config, logger):
+    """
+    Create an HTTP client whose connection pool is kept for the lifetime of
+    the app, so that requests reuse open connections instead of doing a new
+    TCP and TLS handshake every time. `httpx.Client` is thread-safe.
+    """
+    return httpx.Client(**get_http_client_kwargs(config, logger))
+
+
+class HostOverloadedError(Exception):
+    pass
+
+
+class Bulkhead(object):
+    """
+    Limit of the number of concurrent requests to a host, and of the number
+    of requests waiting for one of them to finish. Past these limits,
+    requests fail right away instead of piling up. Only used from a single
+    event loop.
+
+    Args:
+        max_concurrency (int): max number of concurrent requests, or 0 for
+            no limit
+        max_queue (int): max number of requests waiting for a concurrent
+            request to finish
+    """
+
+    def __init__(self, max_concurrency, max_queue):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency or 1)
+
+    async def __aenter__(self):
+        if not self.max_concurrency:
+            return
+        if self._semaphore.locked():
+            if self.waiting >= self.max_queue:
+                raise HostOverloadedError(
+                    "{} requests running and {} waiting".format(
+                        self.max_concurrency, self.waiting
+                    )
+                )
+            self.waiting += 1
+            try:
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+    async def __aexit__(self, *args):
+        if self.max_concurrency:
+            self._semaphore.release()
+
+
+class AsyncHTTPClientPool(object):
+    """
+    One `httpx.AsyncClient` per host, kept for the lifetime of the worker
+    process so that requests reuse open connections instead of doing a new
+    TCP and TLS handshake to every host every time.
+
+    The clients' connections are bound to the event loop they are used in,
+    and Flask runs each async view in a new event loop: the clients are only
+    used from `worker_loop`, to which the requests are shipped.
+
+    The number of concurrent requests to each host is limited by a
+    `Bulkhead`: requests to an overloaded host raise `HostOverloadedError`.
+
+    Args:
+        config (dict): app configuration
+        logger: logger to use
+        worker_loop (wts.worker_loop.WorkerLoop)
+    """
+
+    def __init__(self, config, logger, worker_loop):
+        self.client_kwargs = get_http_client_kwargs(config, logger)
+        self.max_concurrency = config["AGGREGATE_MAX_CONCURRENT_REQUESTS"]
+        self.max_queue = config["AGGREGATE_MAX_QUEUED_REQUESTS"]
+        self.worker_loop = worker_loop
+        self._clients = {}
+        self._bulkheads = {}
+        self._in_flight = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_client(self, host):
+        with self._lock:
+            # the parent process' clients are bound to its worker loop
+            if self._pid != os.getpid():
+                self._clients = {}
+                self._bulkheads = {}
+                self._in_flight = {}
+                self._pid = os.getpid()
+            client = self._clients.get(host)
+            if client is None:
+                client = httpx.AsyncClient(**self.client_kwargs)
+                self._clients[host] = client
+            return client
+
+    def get_bulkhead(self, host):
+        with self._lock:
+            bulkhead = self._bulkheads.get(host)
+            if bulkhead is None:
+                bulkhead = Bulkhead(self.max_concurrency, self.max_queue)
+                self._bulkheads[host] = bulkhead
+            return bulkhead
+
+    async def get(self, host, url, **kwargs):
+        """
+        Send a GET request to `url` with `host`'s client, in the worker loop.
+
+        Return:
+            httpx.Response: the response, whose body was read
+        """
+        return await self.worker_loop.run(self._send(host, url, **kwargs))
+
+    async def stream(self, host, url, handler, **kwargs):
+        """
+        Send a GET request to `url` with `host`'s client, in the worker loop,
+        and stream the response body to `handler`.
+
+        Args:
+            host (str): host whose client to use
+            url (str): URL to send the request to
+            handler (callable): coroutine function processing the streamed
+                `httpx.Response`. It runs in the worker loop
+            kwargs: `httpx.AsyncClient.stream` arguments
+
+        Return:
+            the result of `handler`
+        """
+        return await self.worker_loop.run(self._send(host, url, handler, **kwargs))
+
+    async def _send(self, host, url, handler=None, **kwargs):
+        client = self.get_client(host)
+        async with self.get_bulkhead(host):
+            if handler is None:
+                return await client.get(url, **kwargs)
+            async with client.stream("GET", url, **kwargs) as response:
+                return await handler(response)
+
+    async def get_shared(self, host, url, params=None, handler=None, handler_key=None):
+        """
+        Send an unauthenticated GET request to `url` with `host`'s client, in
+        the worker loop. Concurrent calls with the same `url`, `params` and
+        `handler_key` share a single request, which is cancelled if all of
+        them are.
+
+        Args:
+            handler (callable): optional, see `stream`. The handler of the
+                first caller processes the response for all the callers, so
+                its result must only depend on `handler_key`
+            handler_key (hashable): optional, identifies the processing done
+                by `handler`
+
+        Return:
+            httpx.Response: the response, whose body was read, or the result
+                of `handler`. It is shared by the callers and must not be
+                modified
+        """
+        params = params or {}
+        key = (url, tuple(sorted(params.items())), handler_key)
+        with self._lock:
+            entry = self._in_flight.get(key)
+            is_new = entry is None
+            if is_new:
+                request = self._send(host, url, handler, params=params)
+                entry = [self.worker_loop.submit(request), 0]
+                self._in_flight[key] = entry
+            entry[1] += 1
+        future = entry[0]
+        if is_new:
+            future.add_done_callback(lambda f: self._remove_in_flight(key, entry))
+        try:
+            # a caller giving up must not cancel the request of the others
+            return await asyncio.shield(asyncio.wrap_future(future))
+        except asyncio.CancelledError:
+            with self._lock:
+                entry[1] -= 1
+                abandoned = entry[1] == 0
+                if abandoned and self._in_flight.get(key) is entry:
+                    del self._in_flight[key]
+            if abandoned:
+                future.cancel()
+            raise
+
+    def _remove_in_flight(self, key, entry):
+        with self._lock:
+            if self._in_flight.get(key) is entry:
+                del self._in_flight[key]
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values()) if self._pid == os.getpid() else []
+            self._clients = {}
+            # the bulkheads are bound to the worker loop too
+            self._bulkheads = {}
+        for client in clients:
+            try:
+                self.worker_loop.submit(client.aclose()).result(timeout=5)
+            except Exception:
+                pass
@@ -0,0 +1,40 @@
+import json
+
+
+class ResponseTooLargeError(Exception):
+    pass
+
+
+async def parse_json_response(response, projection=None, max_size=0):
+    """
+    Read the body of a streamed `httpx.Response` and parse it, only keeping
+    the parts selected by `projection`.
+
+    The body is read as it is received, and aborted as soon as it is larger
+    than `max_size`, so that an oversized body is never buffered whole.
+
+    Args:
+        response (httpx.Response): streamed response
+        projection (wts.projection.Projection): parts of the body to keep, or
+            None to keep the whole body
+        max_size (int): max number of bytes in the body, or 0 for no limit
+
+    Raises:
+        ResponseTooLargeError: if the body is larger than `max_size`
+    """
+    check_content_length(response, max_size)
+    body = bytearray()
+    async for chunk in response.aiter_bytes():
+        body += chunk
+        if max_size and len(body) > max_size:
+            raise ResponseTooLargeError(
+                "Response is larger than {} bytes".format(max_size)
+            )
+    data = json.loads(body)
+    return projection.apply(data) if projection else data
+
+
+def check_content_length(response, max_size):
+    content_length = response.headers.get("Content-Length")
+    if max_size and content_length and int(content_length) > max_size:
+        raise ResponseTooLargeError("Response is larger than {} bytes".format(max_size))
@@ -0,0 +1,131 @@
+import threading
+import time
+
+from authutils.token.keys import refresh_jwt_public_keys
+
+
+def fetch_issuer_public_keys(issuer, logger=None):
+    """
+    Get the public keys of `issuer`, from its OIDC discovery document's
+    `jwks_uri` or from the Fence `/jwt/keys` endpoint.
+
+    Return:
+        dict: key ID to public key in PEM format
+    """
+    keys = {}
+    refresh_jwt_public_keys(user_api=issuer, pkey_cache=keys, logger=logger)
+    return keys[issuer]
+
+
+class JWTKeyStore(object):
+    """
+    Public keys used to validate the JWTs of each configured issuer.
+
+    The keys are fetched when the store is started, then refreshed in a
+    background thread every `refresh_interval` seconds, so that looking up a
+    key never does network I/O. When a token is signed with an unknown key
+    (the issuer rotated its keys), a refresh of the issuer's keys is
+    requested from the background thread, at most once every
+    `min_refresh_interval` seconds per issuer.
+
+    Args:
+        issuers (list): URLs of the token issuers
+        logger: logger to use
+        refresh_interval (int)
+        min_refresh_interval (int)
+        fetch_keys (callable, optional): returns the {kid: key} dict of an
+            issuer. Default: `fetch_issuer_public_keys`
+    """
+
+    def __init__(
+        self,
+        issuers,
+        logger,
+        refresh_interval=3600,
+        min_refresh_interval=60,
+        fetch_keys=None,
+    ):
+        self.issuers = list(issuers)
+        self.logger = logger
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.fetch_keys = fetch_keys or (
+            lambda issuer: fetch_issuer_public_keys(issuer, logger=logger)
+        )
+        self._keys = {}
+        self._attempted_at = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+    def get_key(self, issuer, kid):
+        """
+        Return:
+            str: the public key, or None if the issuer has no key with this
+                ID (a refresh of the issuer's keys is then requested)
+        """
+        key = self._keys.get(issuer, {}).get(kid)
+        if key is None:
+            self.request_refresh(issuer)
+        return key
+
+    def request_refresh(self, issuer):
+        with self._lock:
+            if time.time() - self._attempted_at.get(issuer, 0) < (
+                self.min_refresh_interval
+            ):
+                return
+            # do not request it again until the refresh is done
+            self._attempted_at[issuer] = time.time()
+            self._pending.add(issuer)
+        self._wakeup.set()
+
+    def refresh(self, issuer):
+        """
+        Fetch the keys of `issuer`. If the keys cannot be fetched, the
+        previous keys are kept.
+        """
+        with self._lock:
+            self._attempted_at[issuer] = time.time()
+        try:
+            keys = self.fetch_keys(issuer)
+        except Exception as e:
+            self.logger.error("Unable to get the keys of {}: {}".format(issuer, e))
+            return
+        # replace the whole dict so concurrent lookups are never blocked
+        self._keys = dict(self._keys, **{issuer: dict(keys)})
+
+    def refresh_all(self):
+        for issuer in self.issuers:
+            self.refresh(issuer)
+
+    def run(self):
+        last_refresh = time.time()
+        while not self._stop.is_set():
+            timeout = max(0, last_refresh + self.refresh_interval - time.time())
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            if time.time() - last_refresh >= self.refresh_interval:
+                self.refresh_all()
+                last_refresh = time.time()
+                continue
+            for issuer in pending:
+                self.refresh(issuer)
+
+    def start(self):
+        """
+        Fetch the keys of all the issuers, then keep them up to date in a
+        background thread.
+        """
+        self.refresh_all()
+        thread = threading.Thread(target=self.run, name="jwt-key-store", daemon=True)
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
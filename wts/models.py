@@ -1,7 +1,7 @@
 # database models
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, BigInteger
+from sqlalchemy import Column, Index, Integer, String, BigInteger
 from sqlalchemy.orm import declarative_base
 
 db = SQLAlchemy(engine_options={"pool_size": 10, "max_overflow": 20})
@@ -17,3 +17,7 @@ class RefreshToken(Base):
     userid = Column(String)
     expires = Column(BigInteger)
     idp = Column(String)
+
+    __table_args__ = (
+        Index("refresh_token_username_idp_expires_idx", "username", "idp", "expires"),
+    )
@@ -0,0 +1,122 @@
+from cdiserrors import UserError
+
+WILDCARD = "*"
+
+
+def merge_trees(tree, other):
+    """
+    Merge 2 projection trees. `None` selects the whole value, so it wins
+    over any selection of a part of the value.
+    """
+    if tree is None or other is None:
+        return None
+    merged = dict(tree)
+    for key, subtree in other.items():
+        merged[key] = merge_trees(merged[key], subtree) if key in merged else subtree
+    return merged
+
+
+def expand_wildcards(tree):
+    """
+    Merge the subtree of each node's wildcard into the subtrees of the node's
+    other keys, which the wildcard also matches, so that each key of a value
+    is projected with a single subtree.
+    """
+    if tree is None:
+        return None
+    tree = {key: expand_wildcards(subtree) for key, subtree in tree.items()}
+    if WILDCARD in tree:
+        for key in tree:
+            if key != WILDCARD:
+                tree[key] = merge_trees(tree[key], tree[WILDCARD])
+    return tree
+
+
+class Projection(object):
+    """
+    Selection of parts of JSON documents, compiled from a list of paths.
+
+    Each path is a list of keys separated by dots, such as "authz" or
+    "context.user.name". A "*" key matches all the keys of an object and all
+    the elements of a list. The selected parts of all the paths are merged
+    into a single pruned document: the paths "authz./programs/a.*.method"
+    and "username" select the `method` of each permission on "/programs/a"
+    and the username.
+
+    A key that is not in the document is returned as `null`. Keys other than
+    "*" do not match list elements.
+
+    Args:
+        paths (list): paths to select
+    """
+
+    def __init__(self, paths):
+        # identifies the selection, for example to share the results of
+        # identical projections
+        self.paths = tuple(sorted(set(paths)))
+        tree = {}
+        for path in paths:
+            keys = path.split(".")
+            if not all(keys):
+                raise UserError('Invalid filter "{}": empty key'.format(path))
+            tree = merge_trees(tree, self.path_to_tree(keys))
+        self.tree = expand_wildcards(tree)
+
+    @staticmethod
+    def path_to_tree(keys):
+        tree = None
+        for key in reversed(keys):
+            tree = {key: tree}
+        return tree
+
+    def apply(self, data):
+        """
+        Return:
+            the parts of `data` selected by the paths
+        """
+        return self._project(self.tree, data)
+
+    def selects(self, key):
+        """
+        Return:
+            bool: whether any part of the value of the top-level `key` of a
+                document is selected
+        """
+        return key in self.tree or WILDCARD in self.tree
+
+    def apply_to_item(self, key, value):
+        """
+        Return:
+            the parts of `value`, the value of the top-level `key` of a
+            document, selected by the paths. See `selects`
+        """
+        subtree = self.tree[key] if key in self.tree else self.tree[WILDCARD]
+        return self._project(subtree, value)
+
+    def missing_keys(self, keys):
+        """
+        Return:
+            list: the top-level keys selected by the paths which are not in
+                `keys`
+        """
+        return [key for key in self.tree if key != WILDCARD and key not in keys]
+
+    def _project(self, tree, value):
+        if tree is None:
+            return value
+        if isinstance(value, dict):
+            result = {}
+            for key, subtree in tree.items():
+                if key == WILDCARD:
+                    continue
+                result[key] = (
+                    self._project(subtree, value[key]) if key in value else None
+                )
+            if WILDCARD in tree:
+                for key, item in value.items():
+                    if key not in result:
+                        result[key] = self._project(tree[WILDCARD], item)
+            return result
+        if isinstance(value, list) and WILDCARD in tree:
+            return [self._project(tree[WILDCARD], item) for item in value]
+        return None
@@ -4,10 +4,10 @@ import flask
 from jose import jwt
 import uuid
 
-from authutils.user import current_user
 from cdiserrors import AuthError
 
 from ..models import RefreshToken, db
+from ..token_validation import get_current_user
 from ..utils import get_oauth_client
 
 
@@ -90,13 +90,8 @@ def refresh_refresh_token(tokens, idp, username_field):
         bytes(refresh_token, encoding="utf8")
     ).decode("utf8")
 
-    # get the username of the current logged in user.
-    # `current_user` validates the token and relies on `OIDC_ISSUER`
-    # to know the issuer
-    client = get_oauth_client(idp="default")
-    flask.current_app.config["OIDC_ISSUER"] = client.metadata["api_base_url"].strip("/")
-    flask.current_app.config["USER_API"] = client.metadata["api_base_url"].rstrip("/")
-    user = current_user
+    # get the username of the current logged in user
+    user = get_current_user(idp="default")
     username = user.username
 
     idp_username = id_token
@@ -127,3 +122,11 @@ def refresh_refresh_token(tokens, idp, username_field):
     db.session.add(new_token)
     db.session.commit()
     db.session.close()
+
+    # access tokens minted from the old refresh token should not be reused
+    flask.current_app.access_token_cache.invalidate(username, idp)
+    # the refresh token expirations listed by `/external_oidc` changed
+    flask.current_app.refresh_token_expiration_cache.invalidate(username)
+    flask.current_app.refresh_token_events.publish(username)
+    # the user's `/aggregate` responses may include another commons
+    flask.current_app.aggregate_response_cache.invalidate(username)
@@ -0,0 +1,88 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class AggregateResponseCache(object):
+    """
+    Cache of the responses of each commons to `/aggregate` requests, keyed by
+    (username, commons hostname, endpoint, parameters, filters). Each entry
+    expires after the TTL configured for its endpoint. Once `max_size`
+    entries are cached, or once the cached responses are larger than
+    `max_bytes` in total, the least recently used entries are evicted.
+
+    The size of a response is the length of its JSON serialization; the
+    parsed response takes several times more memory. A response larger than
+    `max_bytes` is not cached.
+
+    Each worker process has its own cache.
+    """
+
+    def __init__(self, max_size=1000, max_bytes=20000000):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(username, commons, endpoint, parameters, filters):
+        return (
+            username,
+            commons,
+            endpoint,
+            tuple(sorted(parameters.items())),
+            tuple(sorted(filters)),
+        )
+
+    def get(self, username, commons, endpoint, parameters, filters):
+        """
+        Return:
+            dict: the commons' cached response, or None
+        """
+        key = self.make_key(username, commons, endpoint, parameters, filters)
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            response, expires_at, _ = entry
+            if expires_at <= time.time():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def set(self, username, commons, endpoint, parameters, filters, response, ttl):
+        if ttl <= 0 or self.max_size <= 0 or self.max_bytes <= 0:
+            return
+        size = len(json.dumps(response, separators=(",", ":")))
+        if size > self.max_bytes:
+            return
+        key = self.make_key(username, commons, endpoint, parameters, filters)
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (response, time.time() + ttl, size)
+            self.size_bytes += size
+            while (
+                len(self._entries) > self.max_size or self.size_bytes > self.max_bytes
+            ):
+                self._pop(next(iter(self._entries)))
+
+    def invalidate(self, username):
+        """
+        Evict all the cached responses of `username`.
+        """
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == username]:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size_bytes -= entry[2]
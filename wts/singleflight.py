@@ -0,0 +1,104 @@
+import asyncio
+import concurrent.futures
+import threading
+
+
+class LeaderCancelledError(Exception):
+    """
+    The leader of a call was cancelled before the call completed: the
+    callers waiting for it make the call again.
+    """
+
+
+class SingleFlight(object):
+    """
+    Deduplicate concurrent calls that share the same key: the first caller
+    (the "leader") runs the call, and the callers that arrive while it is in
+    progress wait for its result instead of running it again.
+
+    The result is shared through a `concurrent.futures.Future`, so callers
+    can be in different threads and different event loops, and synchronous
+    and asynchronous callers can wait for the same call.
+
+    If the leader is cancelled (or interrupted), its cancellation is not
+    passed on to the waiting callers, which have their own deadlines: one of
+    them becomes the new leader and makes the call again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        """
+        Return:
+            tuple: (concurrent.futures.Future, bool): the future for the call
+                in progress for `key`, and whether the caller is the leader
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future:
+                return future, False
+            future = concurrent.futures.Future()
+            self._calls[key] = future
+            return future, True
+
+    def _finish(self, key, future, result=None, exception=None):
+        with self._lock:
+            del self._calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call `fn(*args, **kwargs)`, unless a call for `key` is already in
+        progress, in which case wait for it and return its result (or raise
+        its exception).
+        """
+        while True:
+            future, is_leader = self._join(key)
+            if is_leader:
+                break
+            try:
+                return future.result()
+            except LeaderCancelledError:
+                continue
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            raise
+        except BaseException:
+            self._finish(key, future, exception=LeaderCancelledError())
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    async def do_async(self, key, coroutine_fn, *args, **kwargs):
+        """
+        Asynchronous version of `do`: await `coroutine_fn(*args, **kwargs)`,
+        unless a call for `key` is already in progress.
+        """
+        while True:
+            future, is_leader = self._join(key)
+            if is_leader:
+                break
+            try:
+                # shield the shared future so that a cancelled follower does
+                # not cancel the call for the other callers
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except LeaderCancelledError:
+                continue
+        try:
+            result = await coroutine_fn(*args, **kwargs)
+        except Exception as e:
+            self._finish(key, future, exception=e)
+            raise
+        except BaseException:
+            # includes `asyncio.CancelledError`
+            self._finish(key, future, exception=LeaderCancelledError())
+            raise
+        self._finish(key, future, result=result)
+        return result
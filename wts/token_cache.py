@@ -0,0 +1,287 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from jose import jwt
+
+
+def get_token_expiration(access_token):
+    """
+    Read the `exp` claim of `access_token` without verifying it. WTS only
+    relays the tokens it gets from the IdP, so the claims are trusted.
+
+    Args:
+        access_token (str): encoded JWT
+
+    Return:
+        int: expiration timestamp, or None if the token is not a JWT or has
+            no `exp` claim
+    """
+    try:
+        return int(jwt.get_unverified_claims(access_token)["exp"])
+    except Exception:
+        return None
+
+
+def get_access_token_cache(config, encryption_key):
+    """
+    Create the access token cache configured by `ACCESS_TOKEN_CACHE_BACKEND`.
+
+    Args:
+        config (dict): app configuration
+        encryption_key (cryptography.fernet.Fernet): key used by backends
+            that store access tokens outside of the process memory
+
+    Return:
+        BaseAccessTokenCache
+    """
+    backend = config["ACCESS_TOKEN_CACHE_BACKEND"]
+    kwargs = {
+        "max_size": config["ACCESS_TOKEN_CACHE_MAX_SIZE"],
+        "margin": config["ACCESS_TOKEN_CACHE_EXPIRATION_MARGIN"],
+    }
+    if backend == "memory":
+        return MemoryAccessTokenCache(**kwargs)
+    if backend == "sqlite":
+        return SQLiteAccessTokenCache(
+            config["ACCESS_TOKEN_CACHE_PATH"], encryption_key, **kwargs
+        )
+    raise Exception(
+        'Unknown access token cache backend "{}", abort initialization'.format(backend)
+    )
+
+
+class BaseAccessTokenCache(object):
+    """
+    Cache of the access tokens minted from users' refresh tokens, keyed by
+    (username, IdP).
+
+    An entry is evicted `margin` seconds before the access token's `exp`, so
+    a cached token is never handed out right before it expires. Once
+    `max_size` entries are cached, older entries are evicted.
+    """
+
+    def __init__(self, max_size=1000, margin=60):
+        self.max_size = max_size
+        self.margin = margin
+
+    def get(self, username, idp, min_lifetime=None):
+        """
+        Args:
+            username (str)
+            idp (str)
+            min_lifetime (int, optional): only return the cached token if it
+                is valid for at least this many more seconds
+
+        Return:
+            str: cached access token, or None
+        """
+        raise NotImplementedError()
+
+    def set(self, username, idp, access_token):
+        """
+        Cache `access_token` until its `exp` claim minus the safety margin.
+        Tokens whose expiration cannot be read are not cached.
+        """
+        raise NotImplementedError()
+
+    def invalidate(self, username, idp):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def _is_usable(self, exp, now, min_lifetime=None):
+        if exp - self.margin <= now:
+            return False
+        return not min_lifetime or exp - now >= min_lifetime
+
+
+class MemoryAccessTokenCache(BaseAccessTokenCache):
+    """
+    In-process cache, with least recently used eviction. Each worker process
+    has its own.
+    """
+
+    def __init__(self, max_size=1000, margin=60):
+        super(MemoryAccessTokenCache, self).__init__(max_size=max_size, margin=margin)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username, idp, min_lifetime=None):
+        key = (username, idp)
+        now = int(time.time())
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            access_token, exp = entry
+            if exp - self.margin <= now:
+                del self._entries[key]
+                return None
+            if min_lifetime and exp - now < min_lifetime:
+                return None
+            self._entries.move_to_end(key)
+            return access_token
+
+    def set(self, username, idp, access_token):
+        exp = get_token_expiration(access_token)
+        if not exp or not self._is_usable(exp, int(time.time())):
+            return
+        key = (username, idp)
+        with self._lock:
+            self._entries[key] = (access_token, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username, idp):
+        with self._lock:
+            self._entries.pop((username, idp), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteAccessTokenCache(BaseAccessTokenCache):
+    """
+    Cache stored in a local SQLite file in WAL mode, so that all the worker
+    processes on a node share the access tokens they mint. Access tokens are
+    encrypted at rest with the app's encryption key. When the cache is full,
+    the entries closest to their expiration are evicted first.
+    """
+
+    def __init__(self, path, encryption_key, max_size=1000, margin=60):
+        super(SQLiteAccessTokenCache, self).__init__(max_size=max_size, margin=margin)
+        self.path = path
+        self.encryption_key = encryption_key
+        self._local = threading.local()
+        # only the service user should be able to read the cache
+        os.close(os.open(self.path, os.O_CREAT | os.O_RDWR, 0o600))
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS access_token ("
+                "username TEXT NOT NULL, "
+                "idp TEXT NOT NULL, "
+                "token TEXT NOT NULL, "
+                "exp INTEGER NOT NULL, "
+                "PRIMARY KEY (username, idp))"
+            )
+
+    def _connection(self):
+        """
+        Return this thread's connection to the cache file. Connections are
+        not shared across threads, nor with processes forked after they were
+        opened.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, username, idp, min_lifetime=None):
+        now = int(time.time())
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT token, exp FROM access_token WHERE username = ? AND idp = ?",
+            (username, idp),
+        ).fetchone()
+        if not row:
+            return None
+        token, exp = row
+        if not self._is_usable(exp, now, min_lifetime):
+            return None
+        return self.encryption_key.decrypt(token.encode("utf-8")).decode("utf-8")
+
+    def set(self, username, idp, access_token):
+        now = int(time.time())
+        exp = get_token_expiration(access_token)
+        if not exp or not self._is_usable(exp, now):
+            return
+        token = self.encryption_key.encrypt(access_token.encode("utf-8")).decode(
+            "utf-8"
+        )
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO access_token (username, idp, token, exp) "
+                "VALUES (?, ?, ?, ?)",
+                (username, idp, token, exp),
+            )
+            conn.execute(
+                "DELETE FROM access_token WHERE exp - ? <= ?", (self.margin, now)
+            )
+            conn.execute(
+                "DELETE FROM access_token WHERE rowid IN ("
+                "SELECT rowid FROM access_token ORDER BY exp DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,),
+            )
+
+    def invalidate(self, username, idp):
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM access_token WHERE username = ? AND idp = ?",
+                (username, idp),
+            )
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM access_token")
+
+
+class RefreshTokenExpirationCache(object):
+    """
+    Short-lived cache of the expiration of each user's most recent refresh
+    token for each IdP, so that the clients polling `/external_oidc` do not
+    query the database every time.
+
+    An entry is invalidated when one of the user's refresh tokens is
+    replaced by this worker; other workers may keep returning the previous
+    expirations for up to `ttl` seconds. A `ttl` of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=30, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username):
+        """
+        Return:
+            dict: IdP to expiration timestamp of the user's most recent
+                refresh token (None if there is none), or None if the
+                user's expirations are not cached
+        """
+        with self._lock:
+            entry = self._entries.get(username)
+            if not entry:
+                return None
+            expirations, cached_at = entry
+            if time.time() - cached_at >= self.ttl:
+                del self._entries[username]
+                return None
+            return expirations
+
+    def set(self, username, expirations):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[username] = (dict(expirations), time.time())
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
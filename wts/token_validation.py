@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from authutils.errors import JWTError
+from authutils.token.core import get_kid
+from authutils.token.validate import get_jwt_token, validate_jwt
+from authutils.user import set_current_user
+
+from .utils import get_token_validator
+
+
+def hash_token(encoded_token):
+    return hashlib.sha256(encoded_token.encode("utf-8")).hexdigest()
+
+
+class ValidatedClaimsCache(object):
+    """
+    Cache of the claims of the JWTs that were successfully validated, keyed
+    by (issuer, SHA-256 hash of the token) so the tokens themselves are not
+    kept in memory. An entry expires at the token's `exp`. Once `max_size`
+    entries are cached, the least recently used entries are evicted.
+
+    Each worker process has its own cache.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, issuer, encoded_token):
+        """
+        Return:
+            dict: claims of the token if it was validated for this issuer
+                and is not expired, or None
+        """
+        key = (issuer, hash_token(encoded_token))
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            claims, exp = entry
+            if exp <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def set(self, issuer, encoded_token, claims):
+        """
+        Cache the claims of a validated token. Tokens without `exp` claim
+        are not cached.
+        """
+        exp = claims.get("exp")
+        if not exp or exp <= time.time() or self.max_size <= 0:
+            return
+        key = (issuer, hash_token(encoded_token))
+        with self._lock:
+            self._entries[key] = (claims, exp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TokenValidator(object):
+    """
+    Validate the access tokens issued by one issuer.
+
+    One validator is built per IdP when the app is set up, and shared by all
+    the requests: its attributes are not modified afterwards and it holds no
+    per-request state, so it is safe to use from concurrent threads or
+    coroutines. Tokens are validated with the keys from `key_store`, so
+    validating never waits for the keys to be fetched, and the claims of
+    validated tokens are cached in `claims_cache` until the tokens expire.
+
+    Args:
+        issuer (str): URL of the issuer the tokens must be issued by
+        key_store (wts.jwt_keys.JWTKeyStore)
+        claims_cache (ValidatedClaimsCache)
+        scope (iterable): scopes the tokens must have
+        purpose (str): purpose the tokens must have
+    """
+
+    def __init__(
+        self, issuer, key_store, claims_cache, scope=("openid",), purpose="access"
+    ):
+        self.issuer = issuer
+        self.key_store = key_store
+        self.claims_cache = claims_cache
+        self.scope = frozenset(scope)
+        self.purpose = purpose
+
+    def validate(self, encoded_token):
+        """
+        Return:
+            dict: the token's claims
+
+        Raises:
+            authutils.errors.JWTError: if the token is not valid
+        """
+        claims = self.claims_cache.get(self.issuer, encoded_token)
+        if claims:
+            return claims
+
+        kid = get_kid(encoded_token)
+        public_key = self.key_store.get_key(self.issuer, kid)
+        if not public_key:
+            raise JWTError("no key exists with given key id: {}".format(kid))
+        claims = validate_jwt(
+            encoded_token,
+            scope=set(self.scope),
+            purpose=self.purpose,
+            issuers=[self.issuer],
+            public_key=public_key,
+            attempt_refresh=False,
+        )
+        self.claims_cache.set(self.issuer, encoded_token, claims)
+        return claims
+
+
+def get_current_user(idp="default"):
+    """
+    Get the user identified by the JWT in the current request's
+    Authorization header, validated by the IdP's `TokenValidator`.
+
+    Args:
+        idp (str, optional): IdP whose issuer the token must be issued by
+
+    Return:
+        authutils.user.CurrentUser
+
+    Raises:
+        authutils.errors.JWTError: if the token is missing or not valid
+    """
+    validator = get_token_validator(idp=idp)
+    encoded_token = get_jwt_token()
+    if not encoded_token:
+        raise JWTError("no authorization header provided")
+    return set_current_user(claims=validator.validate(encoded_token))
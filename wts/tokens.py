@@ -1,3 +1,4 @@
+import asyncio
 import flask
 import time
 import httpx
@@ -5,7 +6,11 @@ import httpx
 from cdiserrors import AuthError, InternalError, UserError
 
 from .models import db, RefreshToken
-from .utils import get_oauth_client
+from .singleflight import SingleFlight
+from .utils import get_http_client, get_oauth_client
+
+# refreshes in progress, keyed by (username, IdP)
+in_flight_requests = SingleFlight()
 
 
 def get_data_for_fence_request(refresh_token):
@@ -29,46 +34,91 @@ def get_data_for_fence_request(refresh_token):
 
 
 def get_access_token(requested_idp, expires=None):
+    """
+    Get an access token for the current user and `requested_idp`. A cached
+    access token is returned if it is still valid for at least `expires`
+    seconds; otherwise a new one is obtained using the user's refresh token.
+    Concurrent requests for the same user and IdP share a single call to the
+    IdP.
+
+    Args:
+        requested_idp (str): IdP to get an access token for
+        expires (int, optional): minimum remaining lifetime, in seconds, of
+            the returned access token if it comes from the cache
+
+    Return:
+        str: access token
+    """
     try:
         if requested_idp not in flask.current_app.oauth2_clients:
             raise UserError(
                 'Requested IdP "{}" is not configured'.format(requested_idp)
             )
         username = flask.g.user.username
-        flask.current_app.logger.info(
-            "Getting refresh token for user '{}', IdP '{}'".format(
-                username, requested_idp
-            )
-        )
-        refresh_token = (
-            db.session.query(RefreshToken)
-            .filter_by(username=username)
-            .filter_by(idp=requested_idp)
-            .order_by(RefreshToken.expires.desc())
-            .first()
+        access_token = flask.current_app.access_token_cache.get(
+            username, requested_idp, min_lifetime=expires
         )
-        now = int(time.time())
-        if not refresh_token:
-            raise AuthError("User doesn't have a refresh token")
-        if refresh_token.expires <= now:
-            raise AuthError("your refresh token is expired, please login again")
-        url, data, auth = get_data_for_fence_request(refresh_token)
-        try:
-            r = httpx.post(url, data=data, auth=auth)
-        except Exception:
-            raise InternalError("Fail to reach fence")
-        if r.status_code != 200:
-            raise InternalError(
-                "Fail to get a access token from fence: {}".format(r.text)
+        if access_token:
+            flask.current_app.logger.info(
+                "Using cached access token for user '{}', IdP '{}'".format(
+                    username, requested_idp
+                )
             )
-        return r.json()["access_token"]
+            return access_token
+        return in_flight_requests.do(
+            (username, requested_idp),
+            fetch_access_token,
+            username,
+            requested_idp,
+            expires=expires,
+        )
     finally:
         db.session.close()
 
 
+def fetch_access_token(username, requested_idp, expires=None):
+    """
+    Obtain a new access token from `requested_idp` using the user's most
+    recent refresh token, and cache it.
+    """
+    # a concurrent request may have cached a token since the cache was checked
+    access_token = flask.current_app.access_token_cache.get(
+        username, requested_idp, min_lifetime=expires
+    )
+    if access_token:
+        return access_token
+    flask.current_app.logger.info(
+        "Getting refresh token for user '{}', IdP '{}'".format(username, requested_idp)
+    )
+    refresh_token = (
+        db.session.query(RefreshToken)
+        .filter_by(username=username)
+        .filter_by(idp=requested_idp)
+        .order_by(RefreshToken.expires.desc())
+        .first()
+    )
+    now = int(time.time())
+    if not refresh_token:
+        raise AuthError("User doesn't have a refresh token")
+    if refresh_token.expires <= now:
+        raise AuthError("your refresh token is expired, please login again")
+    url, data, auth = get_data_for_fence_request(refresh_token)
+    try:
+        r = get_http_client(idp=requested_idp).post(url, data=data, auth=auth)
+    except Exception:
+        raise InternalError("Fail to reach fence")
+    if r.status_code != 200:
+        raise InternalError("Fail to get a access token from fence: {}".format(r.text))
+    access_token = r.json()["access_token"]
+    flask.current_app.access_token_cache.set(username, requested_idp, access_token)
+    return access_token
+
+
 async def async_get_access_token(refresh_token, commons_hostname=None):
     """
     Make an asynchronous request to obtain an access token given 'refresh_token'.
+    Concurrent requests for the same user and IdP, including synchronous
+    ones, share a single call to the IdP.
 
     Args:
         refresh_token (wts.models.RefreshToken): refresh token reference
@@ -84,13 +134,17 @@ async def async_get_access_token(refresh_token, commons_hostname=None):
         commons_hostname = flask.current_app.config["OIDC"][refresh_token.idp][
             "commons_hostname"
         ]
-    access_token = None
+    access_token = flask.current_app.access_token_cache.get(
+        refresh_token.username, refresh_token.idp
+    )
+    if access_token:
+        return commons_hostname, access_token
     try:
-        url, data, auth = get_data_for_fence_request(refresh_token)
-        async with httpx.AsyncClient() as http_client:
-            res = await http_client.post(url, data=data, auth=auth)
-            res.raise_for_status()
-            access_token = res.json()["access_token"]
+        access_token = await in_flight_requests.do_async(
+            (refresh_token.username, refresh_token.idp),
+            async_fetch_access_token,
+            refresh_token,
+        )
     except httpx.RequestError as e:
         flask.current_app.logger.error(
             "Failed to POST {} to obtain access token".format(e.request.url)
@@ -108,3 +162,25 @@ async def async_get_access_token(refresh_token, commons_hostname=None):
             )
         )
     return commons_hostname, access_token
+
+
+async def async_fetch_access_token(refresh_token):
+    """
+    Obtain a new access token using `refresh_token`, and cache it.
+    """
+    access_token = flask.current_app.access_token_cache.get(
+        refresh_token.username, refresh_token.idp
+    )
+    if access_token:
+        return access_token
+    url, data, auth = get_data_for_fence_request(refresh_token)
+    # use the IdP's pooled client, which the sync token exchanges also use,
+    # instead of opening new connections from this request's event loop
+    http_client = get_http_client(idp=refresh_token.idp)
+    res = await asyncio.to_thread(http_client.post, url, data=data, auth=auth)
+    res.raise_for_status()
+    access_token = res.json()["access_token"]
+    flask.current_app.access_token_cache.set(
+        refresh_token.username, refresh_token.idp, access_token
+    )
+    return access_token
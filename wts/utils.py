@@ -1,3 +1,4 @@
+import asyncio
 import flask
 import json
 import os
@@ -41,3 +42,66 @@ def get_oauth_client(idp=None):
         )
         raise UserError('Requested IdP "{}" is not configured'.format(idp))
     return client
+
+
+def get_http_client(idp=None):
+    """
+    Args:
+        idp (str, optional): IdP for the HTTP client to return. If not
+            provided, will return the default IdP's HTTP client.
+
+    Returns:
+        httpx.Client: client with a connection pool to the IdP
+    """
+    idp = idp or "default"
+    try:
+        client = flask.current_app.http_clients[idp]
+    except KeyError:
+        flask.current_app.logger.exception(
+            'Requested IdP "{}" is not configured'.format(idp)
+        )
+        raise UserError('Requested IdP "{}" is not configured'.format(idp))
+    return client
+
+
+def get_token_validator(idp=None):
+    """
+    Args:
+        idp (str, optional): IdP whose tokens the validator validates. If
+            not provided, will return the default IdP's validator.
+
+    Returns:
+        wts.token_validation.TokenValidator
+    """
+    idp = idp or "default"
+    try:
+        validator = flask.current_app.token_validators[idp]
+    except KeyError:
+        flask.current_app.logger.exception(
+            'Requested IdP "{}" is not configured'.format(idp)
+        )
+        raise UserError('Requested IdP "{}" is not configured'.format(idp))
+    return validator
+
+
+async def run_db_query(fn, *args):
+    """
+    Run `fn(*args)`, a function querying the database, in the app's
+    database executor, so that the event loop is not blocked while waiting
+    for the database.
+
+    `fn` runs in a new app context, whose database session is removed when
+    `fn` returns, so sessions are not held across awaits. The objects it
+    returns are detached from the session: their attributes must be loaded.
+
+    Return:
+        the result of `fn`
+    """
+    app = flask.current_app._get_current_object()
+
+    def run():
+        with app.app_context():
+            return fn(*args)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.db_executor, run)
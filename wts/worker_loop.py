@@ -0,0 +1,85 @@
+import asyncio
+import atexit
+import os
+import threading
+
+
+class WorkerLoop(object):
+    """
+    An event loop running in a daemon thread for the lifetime of the worker
+    process.
+
+    Flask runs each async view in a new event loop, which is closed at the
+    end of the request, so objects bound to an event loop (such as the
+    connection pools of `httpx.AsyncClient`) cannot be shared between
+    requests. They can live in this loop instead: requests ship the
+    coroutines doing the I/O to it and await their result.
+
+    The loop is started on first use, and started again in a forked child
+    process, in which the parent's thread does not exist.
+
+    When the app is served by an ASGI server, the server's event loop, in
+    which the async views run, is used instead (see `use`).
+    """
+
+    def __init__(self, name="wts-worker-loop"):
+        self.name = name
+        self._loop = None
+        self._owned = False
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._owned = True
+                self._pid = os.getpid()
+                thread = threading.Thread(
+                    target=self._loop.run_forever, name=self.name, daemon=True
+                )
+                thread.start()
+            return self._loop
+
+    def submit(self, coroutine):
+        """
+        Run `coroutine` in the worker loop.
+
+        Return:
+            concurrent.futures.Future: the coroutine's result. Cancelling it
+                cancels the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def run(self, coroutine):
+        """
+        Run `coroutine` in the worker loop and wait for its result from the
+        calling event loop. If the calling task is cancelled, the coroutine
+        is cancelled too.
+        """
+        if asyncio.get_running_loop() is self.loop:
+            return await coroutine
+        return await asyncio.wrap_future(self.submit(coroutine))
+
+    def use(self, loop):
+        """
+        Use `loop`, an event loop running for the lifetime of this process,
+        instead of running one in a thread. The loop is not stopped by
+        `stop`.
+        """
+        self.stop()
+        with self._lock:
+            self._loop = loop
+            self._owned = False
+            self._pid = os.getpid()
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None and self._owned and self._pid == os.getpid():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+
+worker_loop = WorkerLoop()
+atexit.register(worker_loop.stop)